@@ -7,6 +7,7 @@
 
 import struct
 import mmap
+from collections import namedtuple
 
 # Global params for creating the base object.
 AC_PHYSICS = 1
@@ -28,8 +29,75 @@ AC_TIME_ATTACK = 4
 AC_DRIFT = 5
 AC_DRAG = 6
 
+# packetId is the first field of the physics and graphics sections.
+PACKET_ID = struct.Struct("<L")
+
+# Base class for the shared memory sections, handles the memory mapping.
+class AcSection(object):
+	memStruct = {}
+	size = 0
+	tagname = ""
+
+	# Open memory handle, a buffer can be given instead (i.e. when running outside of AC).
+	def __init__(self, handle=None):
+		if handle is None:
+			handle = mmap.mmap(0, self.size, self.tagname)
+		self.handle = handle
+
+	# Close memory handle automagically when all is done.
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		if getattr(self, "handle", None) is not None:
+			self.handle.close()
+			self.handle = None
+
+	@property
+	def closed(self):
+		return self.handle is None or getattr(self.handle, "closed", False)
+
+	# Build a struct.Struct for the whole section from memStruct, with the record type it decodes to.
+	@classmethod
+	def compile(cls):
+		fmt = "<"
+		names = []
+		fields = []	# (first value index, number of values, is string) for each name
+		pos = 0
+		index = 0
+		for name, field in sorted(cls.memStruct.items(), key=lambda item: item[1]["offset"]):
+			if field["offset"] < pos:
+				raise ValueError("%s.%s overlaps the previous field" % (cls.__name__, name))
+			if field["offset"] > pos:
+				fmt += "%dx" % (field["offset"] - pos)
+			num = field.get("num", 1)
+			fmt += field["type"] if num == 1 else "%d%s" % (num, field["type"])
+			names.append(name)
+			fields.append((index, num, field["type"].find("s") != -1))
+			pos = field["offset"] + field["size"] * num
+			index += num
+		if pos < cls.size:
+			fmt += "%dx" % (cls.size - pos)
+		cls.struct = struct.Struct(fmt)
+		if cls.struct.size != cls.size:
+			raise ValueError("%s layout is %d bytes, expected %d" % (cls.__name__, cls.struct.size, cls.size))
+		cls.fields = fields
+		cls.Record = namedtuple(cls.__name__ + "Record", names)
+
+	# Decode a whole section from buffer in one call. Fields with subcomponents are returned as tuples.
+	@classmethod
+	def decode(cls, buffer, offset=0):
+		raw = cls.struct.unpack_from(buffer, offset)
+		return cls.Record._make([
+			bytesToString(raw[i]) if string else raw[i] if num == 1 else raw[i:i + num]
+			for i, num, string in cls.fields])
+
+	def read(self):
+		return self.decode(self.handle)
+
+
 # Physics struct.
-class AcPhysics(object):
+class AcPhysics(AcSection):
 	memStruct = {"packetId": 				{"offset": 0, "size": 4, "type": "L", "val": 0},
 				"gas": 						{"offset": 4, "size": 4, "type": "f", "val": 0},
 				"brake": 					{"offset": 8, "size": 4, "type": "f", "val": 0},
@@ -56,7 +124,7 @@ class AcPhysics(object):
 																									"x": 0, 
 																									"y": 0, 
 																									"z": 0}},
-				"wheelAngularSpeed":		{"offset": 108, "size": 4, "type": "f", "num": 4, "val": 	{"w": 0, 
+				"wheelAngularSpeed":		{"offset": 104, "size": 4, "type": "f", "num": 4, "val": 	{"w": 0, 
 																										"x": 0, 
 																										"y": 0, 
 																										"z": 0}},
@@ -96,17 +164,10 @@ class AcPhysics(object):
 				"abs": 						{"offset": 252, "size": 4, "type": "f", "val": 0}
 				}
 	size = 256
-	
-	# Open memory handle.
-	def __init__(self):
-		self.handle = mmap.mmap(0, self.size, "acpmf_physics")
-	
-	# Close memory handle automagically when all is done.
-	def __del__(self):
-		self.handle.close()
+	tagname = "acpmf_physics"
 		
 		
-class AcGraphics(object):
+class AcGraphics(AcSection):
 	memStruct = {"packetId": 				{"offset": 0, "size": 4, "type": "L", "val": 0},
 				"status": 					{"offset": 4, "size": 4, "type": "L", "val": 0},
 				"session": 					{"offset": 8, "size": 4, "type": "L", "val": 0},
@@ -133,15 +194,10 @@ class AcGraphics(object):
 																										"z": 0}}
 				}
 	size = 148
-	
-	def __init__(self):
-		self.handle = mmap.mmap(0, self.size, "acpmf_graphics")
-		
-	def __del__(self):
-		self.handle.close()
+	tagname = "acpmf_graphics"
 		
 
-class AcStatic(object):
+class AcStatic(AcSection):
 	memStruct = {"smVersion": 			{"offset": 0, "size": 10, "type": "10s", "val": ""},
 				"acVersion": 			{"offset": 10, "size": 10, "type": "10s", "val": ""},
 				"numberOfSessions": 	{"offset": 20, "size": 4, "type": "L", "val": 0},
@@ -166,24 +222,40 @@ class AcStatic(object):
 																									"z": 0}}
 				}
 	size = 240
-	
-	def __init__(self):
-		self.handle = mmap.mmap(0, self.size, "acpmf_static")
-		
-	def __del__(self):
-		self.handle.close()
+	tagname = "acpmf_static"
+
+# Precompile the sections decoders.
+for _section in (AcPhysics, AcGraphics, AcStatic):
+	_section.compile()
+
+
+def bytesToString(bytes):
+	return bytes.split(b"\x00")[0].decode()
+
 
 # Base object that holds the individual struct instances 
 class AcSharedMemory(object):
-	def __init__(self, mode=0x7):
+	# handles can map section names to existing buffers, otherwise the AC mappings are opened.
+	def __init__(self, mode=0x7, handles=None):
 		self.shm = {}
+		handles = handles or {}
+		self.packetIds = {}	# packetId of the last snapshot of each section
 		# Init only the necessary structs.
 		if mode & 0x1:
-			self.shm["physics"] = AcPhysics()
+			self.shm["physics"] = AcPhysics(handles.get("physics"))
 		if mode & 0x2:
-			self.shm["graphics"] = AcGraphics()
+			self.shm["graphics"] = AcGraphics(handles.get("graphics"))
 		if mode & 0x4:
-			self.shm["static"] = AcStatic()
+			self.shm["static"] = AcStatic(handles.get("static"))
+
+	# Close all the memory handles, the object can't be used afterwards.
+	def close(self):
+		for section in self.shm.values():
+			section.close()
+
+	@property
+	def closed(self):
+		return any(section.closed for section in self.shm.values())
 	
 	# Read a single value to the object instance. If the variable is a struct in itself (i.e. with x,y,z etc. components) then all of those are updated.
 	def readValue(self,key,name):
@@ -211,15 +283,33 @@ class AcSharedMemory(object):
 			for i in range(1,len(section)):
 				self.readValue(section[0],section[i])
 			
+	# Read a whole section at once, returns a read-only record of all its values.
 	def readSection(self, key):
-		#self.shm[key].handle.seek(0)
-		bytes = self.shm[key].handle.read(self.shm[key].size)
-		for name in self.shm[key].memStruct:
-			self.readValue(key,name)
+		return self.shm[key].read()
+
+	# Read a consistent copy of a section, returns None if its packetId didn't change since the previous
+	# snapshot (i.e. AC is paused or didn't run a new physics step), or if AC kept writing to it while we
+	# were copying it after 'retries' attempts. Sections without packetId are always read.
+	def snapshot(self, key, retries=3):
+		section = self.shm[key]
+		if "packetId" not in section.memStruct:
+			return section.read()
+
+		for i in range(retries + 1):
+			before = PACKET_ID.unpack_from(section.handle)[0]
+			if before == self.packetIds.get(key):
+				return None
+			data = section.handle[:section.size]
+			if PACKET_ID.unpack_from(section.handle)[0] == before:
+				# packetId didn't change while copying the data, it's not torn
+				record = section.decode(data)
+				self.packetIds[key] = record.packetId
+				return record
+		return None
 
+	# Read all the sections, returns a dict of records.
 	def readAll(self):
-		for key in self.shm.keys():
-			self.readSection(key)
+		return dict((key, section.read()) for key, section in self.shm.items())
 		
 	def bytesToString(self, bytes):
-		return bytes.split(b"\x00")[0].decode()
+		return bytesToString(bytes)
@@ -0,0 +1,260 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Copyright (C) 2014 - Mathias Andre
+
+'''
+Summarise the export files outside of AC: best lap, laptimes, top speeds
+and theoretical best lap for each track/car. Files are read in parallel.
+
+    python analyse.py [-j JOBS] [-s SECTORS] [-o OUTPUT] [EXPORTS_DIR]
+'''
+
+from models import ExportReader, Session, TimingTable
+
+import argparse
+import csv
+import json
+import math
+import multiprocessing
+import os
+import sys
+
+EXPORT_EXTENSIONS = ('.json', '.rlz')
+SECTORS = 20    # Number of mini-sectors used for the theoretical best lap
+
+CSV_FIELDS = ('trackname', 'carname', 'files', 'laps', 'valid_laps',
+              'best_laptime', 'best_file', 'best_lap', 'median_laptime',
+              'top_speed', 'theoretical_best')
+
+
+class QuietSession(Session):
+    '''
+    Session used by the workers, the console messages aren't useful here
+    '''
+    def console(self, msg):
+        pass
+
+
+def sector_times(lap, sectors=SECTORS):
+    '''
+    Returns the time spent in each of the 'sectors' parts of the lap in ms,
+    or None if the lap can't be split. The sectors are equal parts of the
+    distance driven, the times are scaled to the laptime as the last point
+    is recorded a bit before the end of the lap
+    '''
+    if len(lap.points) < 2 or lap.laptime <= 0:
+        return None
+
+    timing = TimingTable(lap)
+    total = timing.distances[-1]
+    if not total or not timing.times[-1]:
+        return None
+
+    boundaries = [timing.time_at(total * sector / sectors) for sector in range(sectors)]
+    boundaries.append(timing.times[-1])
+
+    scale = lap.laptime / timing.times[-1]
+    return [(end - start) * scale for start, end in zip(boundaries, boundaries[1:])]
+
+
+def analyse_file(args):
+    '''
+    Returns the summary of each lap of an export file, run by the workers
+    '''
+    filename, sectors = args
+    reader = ExportReader(filename, QuietSession())
+    header = reader.header()
+    if header is None:
+        return None
+
+    laps = []
+    for lap in reader.laps():
+        laps.append({
+            'lap': lap.count,
+            'laptime': lap.laptime,
+            'invalid': lap.invalid,
+            'points': len(lap.points),
+            'top_speed': max(lap.points.speed) if lap.points else 0,
+            'sectors': sector_times(lap, sectors),
+        })
+
+    return {
+        'file': os.path.basename(filename),
+        'trackname': header.get('trackname', ''),
+        'carname': header.get('carname', ''),
+        'laps': laps,
+    }
+
+
+def percentile(values, ratio):
+    '''
+    Returns the percentile of the sorted list values, interpolated
+    '''
+    position = (len(values) - 1) * ratio
+    i = int(position)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i + 1] - values[i]) * (position - i)
+
+
+def distribution(values):
+    '''
+    Returns the statistics of a list of numbers
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    mean = sum(values) / len(values)
+    return {
+        'count': len(values),
+        'min': values[0],
+        'p25': percentile(values, 0.25),
+        'median': percentile(values, 0.5),
+        'p75': percentile(values, 0.75),
+        'max': values[-1],
+        'mean': mean,
+        'stdev': math.sqrt(sum((v - mean) ** 2 for v in values) / len(values)),
+    }
+
+
+def summarise(results):
+    '''
+    Group the results of analyse_file by track/car, returns a list of
+    summaries sorted by track and car
+    '''
+    groups = {}
+    for result in results:
+        if result is None:
+            continue
+        key = (result['trackname'], result['carname'])
+        groups.setdefault(key, []).append(result)
+
+    summaries = []
+    for (trackname, carname), files in sorted(groups.items()):
+        laps = []
+        for result in files:
+            for lap in result['laps']:
+                laps.append((result['file'], lap))
+        valid = [(filename, lap) for filename, lap in laps
+                 if not lap['invalid'] and lap['laptime'] > 0]
+
+        best = None
+        if valid:
+            filename, lap = min(valid, key=lambda item: item[1]['laptime'])
+            best = {'file': filename, 'lap': lap['lap'], 'laptime': lap['laptime']}
+
+        # Best time of each mini-sector over the valid laps
+        theoretical_best = None
+        sectors = [lap['sectors'] for filename, lap in valid if lap['sectors']]
+        if sectors:
+            theoretical_best = int(round(sum(min(times) for times in zip(*sectors))))
+
+        summaries.append({
+            'trackname': trackname,
+            'carname': carname,
+            'files': len(files),
+            'laps': len(laps),
+            'valid_laps': len(valid),
+            'best_lap': best,
+            'laptimes': distribution([lap['laptime'] for filename, lap in valid]),
+            'top_speed': max([lap['top_speed'] for filename, lap in laps] or [0]),
+            'top_speeds': distribution([lap['top_speed'] for filename, lap in valid]),
+            'theoretical_best': theoretical_best,
+        })
+
+    return summaries
+
+
+def write_csv(summaries, f):
+    writer = csv.writer(f)
+    writer.writerow(CSV_FIELDS)
+    for summary in summaries:
+        best = summary['best_lap'] or {}
+        laptimes = summary['laptimes'] or {}
+        writer.writerow([
+            summary['trackname'],
+            summary['carname'],
+            summary['files'],
+            summary['laps'],
+            summary['valid_laps'],
+            best.get('laptime', ''),
+            best.get('file', ''),
+            best.get('lap', ''),
+            laptimes.get('median', ''),
+            summary['top_speed'],
+            summary['theoretical_best'] or '',
+        ])
+
+
+def list_exports(path):
+    return sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                  if os.path.splitext(filename)[1] in EXPORT_EXTENSIONS)
+
+
+def analyse(filenames, jobs=None, sectors=SECTORS):
+    '''
+    Analyse the files using 'jobs' processes (one per core by default)
+    '''
+    args = [(filename, sectors) for filename in filenames]
+    if jobs == 1 or len(args) < 2:
+        results = [analyse_file(arg) for arg in args]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(analyse_file, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return summarise(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarise the Racing Line export files')
+    parser.add_argument('path', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'exports'),
+                        help='exports directory (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes (default: number of cores)')
+    parser.add_argument('-s', '--sectors', type=int, default=SECTORS,
+                        help='number of mini-sectors (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='summary',
+                        help='output files prefix, .json and .csv are added (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.path):
+        sys.stderr.write('"%s" isn\'t a directory\n' % args.path)
+        return 1
+
+    filenames = list_exports(args.path)
+    if not filenames:
+        sys.stderr.write('No export files in "%s"\n' % args.path)
+        return 1
+
+    summaries = analyse(filenames, args.jobs, args.sectors)
+
+    with open(args.output + '.json', 'w') as f:
+        json.dump(summaries, f, indent=2)
+    with open(args.output + '.csv', 'w', newline='') as f:
+        write_csv(summaries, f)
+
+    for summary in summaries:
+        best = summary['best_lap']
+        sys.stdout.write('%s / %s: %d laps (%d valid), best %s, theoretical best %s\n' % (
+            summary['trackname'], summary['carname'], summary['laps'], summary['valid_laps'],
+            best['laptime'] if best else '-', summary['theoretical_best'] or '-'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,326 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Copyright (C) 2014 - Mathias Andre
+
+'''
+Benchmarks of the code run while driving, on synthetic laps. Results are
+saved as JSON and can be compared with a previous run:
+
+    python bench.py -o before.json
+    python bench.py -c before.json [-t 0.2]
+'''
+
+from acpmf import AcSharedMemory, AcPhysics, AcGraphics, AcStatic
+from models import Lap, Point, Session
+
+import argparse
+import json
+import math
+import mmap
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SIZES = (1000, 10000, 100000)
+TARGET_TIME = 0.05  # Minimum duration of a timed batch (s)
+REPEAT = 5          # Number of timed batches
+THRESHOLD = 0.2     # Slowdown reported as a regression
+
+
+class RecordingAc(object):
+    '''
+    Stand-in for the ac module which counts the GL calls
+    '''
+    def __init__(self):
+        self.calls = 0
+
+    def glBegin(self, mode):
+        self.calls += 1
+
+    def glEnd(self):
+        self.calls += 1
+
+    def glVertex2f(self, x, y):
+        self.calls += 1
+
+    def glColor4f(self, r, g, b, a):
+        self.calls += 1
+
+    def console(self, msg):
+        pass
+
+
+class FakeAcsys(object):
+    class GL(object):
+        LineStrip = 1
+
+
+def synthetic_lap(session, size, seed=0, count=0):
+    '''
+    Returns a lap of 'size' points around a closed track whose shape depends
+    on seed. The speed is limited by the curvature of the track, the
+    acceleration and braking, the inputs and gear follow the speed
+    '''
+    rand = random.Random(seed)
+    harmonics = [(rand.uniform(20, 50), k, rand.uniform(0, 2 * math.pi))
+                 for k in range(2, 12)]
+
+    xs = []
+    zs = []
+    for i in range(size):
+        angle = 2 * math.pi * i / size
+        radius = 600 + sum(a * math.sin(k * angle + phase) for a, k, phase in harmonics)
+        xs.append(radius * math.cos(angle))
+        zs.append(radius * math.sin(angle))
+
+    # Distance between points and curvature from the heading change
+    distances = []
+    curvatures = []
+    for i in range(size):
+        x0, z0 = xs[i - 1], zs[i - 1]
+        x1, z1 = xs[i], zs[i]
+        x2, z2 = xs[(i + 1) % size], zs[(i + 1) % size]
+        d = math.hypot(x2 - x1, z2 - z1)
+        turn = math.atan2(z2 - z1, x2 - x1) - math.atan2(z1 - z0, x1 - x0)
+        turn = (turn + math.pi) % (2 * math.pi) - math.pi
+        distances.append(d)
+        curvatures.append(abs(turn) / d if d else 0)
+
+    # Cornering speed (m/s) limited by 2.5g of lateral acceleration, then by
+    # 1g of acceleration and 3g of braking, twice to wrap around the lap
+    speeds = [min(85.0, math.sqrt(25 / c) if c else 85.0) for c in curvatures]
+    for loop in range(2):
+        for i in range(size):
+            limit = math.sqrt(speeds[i - 1] ** 2 + 2 * 10 * distances[i - 1])
+            speeds[i] = min(speeds[i], limit)
+        for i in range(size - 1, -1, -1):
+            following = (i + 1) % size
+            limit = math.sqrt(speeds[following] ** 2 + 2 * 30 * distances[i])
+            speeds[i] = min(speeds[i], limit)
+
+    lap = Lap(session, count)
+    elapsed = 0.0
+    for i in range(size):
+        change = speeds[(i + 1) % size] - speeds[i]
+        gas = 1.0 if change > 0 else 0.0
+        brake = min(1.0, -change * 2) if change < 0 else 0.0
+        gear = min(6, 2 + int(speeds[i] / 15))
+        lap.points.append(Point(xs[i], rand.uniform(-0.5, 0.5), zs[i], speeds[i] * 3.6,
+                                gas, brake, 0, gear, i / size, elapsed))
+        elapsed += distances[i] / speeds[i] * 1000
+    lap.laptime = int(elapsed)
+    return lap
+
+
+def set_best_speeds(lap, waves=20, ratio=0.05):
+    '''
+    Set the best speeds of the lap a few percents faster or slower than its
+    speeds, alternating 'waves' times over the lap as when comparing laps
+    '''
+    size = len(lap.points)
+    speeds = lap.points.speed
+    best_speeds = lap.points.best_speed
+    for i in range(size):
+        best_speeds[i] = speeds[i] * (1 + ratio * math.sin(2 * math.pi * waves * i / size))
+
+
+def synthetic_session(path, laps, size, export_format='compact'):
+    '''
+    Write an export file of 'laps' laps of 'size' points in path, returns
+    the filename
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    session = Session()
+    session.console = lambda msg: None
+    session.app_path = path
+    session.trackname = 'synthetic'
+    session.carname = 'car'
+    session.export_format = export_format
+    for count in range(laps):
+        session._write_export(synthetic_lap(session, size, seed=count, count=count))
+    filename = session.export_file.f.name
+    session.export_file.close()
+    return filename
+
+
+def render_session():
+    session = Session(RecordingAc(), FakeAcsys)
+    session.app_size_x = 400
+    session.app_size_y = 200
+    return session
+
+
+def time_function(function):
+    '''
+    Returns the minimum and median duration of a call to function, in
+    seconds, and the number of calls per batch
+    '''
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(loops):
+            function()
+        duration = time.perf_counter() - start
+        if duration >= TARGET_TIME:
+            break
+        loops *= 2 if duration * 10 < TARGET_TIME else 10
+
+    results = [duration / loops]
+    for i in range(REPEAT - 1):
+        start = time.perf_counter()
+        for i in range(loops):
+            function()
+        results.append((time.perf_counter() - start) / loops)
+
+    results.sort()
+    return {'min': results[0], 'median': results[len(results) // 2], 'loops': loops}
+
+
+def cycle(function, arguments):
+    '''
+    Returns a function calling function with each of arguments in turn
+    '''
+    state = {'i': 0}
+
+    def call():
+        i = state['i']
+        state['i'] = (i + 1) % len(arguments)
+        return function(*arguments[i])
+    return call
+
+
+def benchmarks(sizes, path):
+    '''
+    Yield (name, function) of the benchmarks
+    '''
+    for size in sizes:
+        session = render_session()
+        lap = synthetic_lap(session, size)
+        # Samples on the same track, as while driving
+        other = synthetic_lap(session, 1000)
+        samples = [(point,) for point in other.points]
+
+        yield 'closest_point[%d]' % size, cycle(lap.closest_point, samples)
+
+        indexed = synthetic_lap(session, size)
+        indexed.build_index()
+        yield 'closest_point_indexed[%d]' % size, cycle(indexed.closest_point, samples)
+
+        # Change the heading at each call so the cache isn't used
+        views = [(point, i / 100.) for i, point in enumerate(other.points)]
+        yield 'normalise[%d]' % size, cycle(lap.normalise, views)
+
+        # The current lap is coloured by comparison with the best lap
+        compared = synthetic_lap(session, size)
+        set_best_speeds(compared)
+        session.zoom = 4.0
+        yield 'render[%d]' % size, cycle(compared.render, views)
+        session.zoom = 1.0
+
+        if size <= 10000:
+            data = lap.json_dumps()
+            yield 'json_dumps[%d]' % size, lap.json_dumps
+            yield 'json_loads[%d]' % size, lambda: Lap(session, 0).json_loads(json.loads(data))
+
+        for export_format in ('compact', 'json'):
+            filename = synthetic_session(os.path.join(path, '%s-%d' % (export_format, size)),
+                                         5, size, export_format)
+
+            def import_data(filename=filename):
+                imported = Session()
+                imported.console = lambda msg: None
+                imported.import_data(filename)
+            yield 'import_data_%s[5x%d]' % (export_format, size), import_data
+
+    handles = dict((section.tagname[len('acpmf_'):], mmap.mmap(-1, section.size))
+                   for section in (AcPhysics, AcGraphics, AcStatic))
+    shm = AcSharedMemory(7, handles=handles)
+    yield 'readValue', lambda: shm.readValue('physics', 'wheelAngularSpeed')
+    yield 'readSection', lambda: shm.readSection('physics')
+    yield 'readAll', shm.readAll
+
+
+def run(sizes, names=None):
+    '''
+    Returns the results of the benchmarks whose name start with one of names
+    '''
+    path = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, function in benchmarks(sizes, path):
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            results[name] = time_function(function)
+            sys.stdout.write('%-32s %12.1f us\n' % (name, results[name]['min'] * 1e6))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(path)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''
+    Returns the list of (name, ratio) of the benchmarks more than threshold
+    slower than in baseline
+    '''
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        if name not in baseline['results']:
+            continue
+        ratio = result['min'] / baseline['results'][name]['min']
+        sys.stdout.write('%-32s %6.2fx\n' % (name, ratio))
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Racing Line benchmarks')
+    parser.add_argument('names', nargs='*', help='only run the benchmarks starting with these')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=list(SIZES),
+                        help='number of points of the laps (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='save the results to this file')
+    parser.add_argument('-c', '--compare', help='compare the results with this file')
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                        help='slowdown reported as a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.names)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, ratio in regressions:
+            sys.stdout.write('Regression: %s is %.2fx slower\n' % (name, ratio))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
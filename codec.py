@@ -0,0 +1,296 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Copyright (C) 2014 - Mathias Andre
+
+'''
+Compact export format: a magic string followed by zlib streams of records.
+Points are quantised to fixed point integers and each channel is stored as
+the differences between consecutive points, using zig-zag varints.
+The stream is ended after the header and each lap or drop record, so a lap
+can be decompressed on its own from the offset of its stream.
+'''
+
+import json
+import zlib
+
+COMPACT_MAGIC = b'RLZ2'
+READ_SIZE = 65536
+
+# Records types
+RECORD_HEADER = 0   # Session header: JSON
+RECORD_LAP = 1      # Lap: count, invalid, laptime, points
+RECORD_CHUNK = 2    # Points streamed during a lap: count, points
+RECORD_DROP = 3     # Drop the chunks of a lap: count
+
+# Point channels and their fixed point scale, 0 is used for None
+# positions and times so they are shifted by one
+CHANNELS = (
+    ('x', 100),
+    ('y', 100),
+    ('z', 100),
+    ('speed', 100),
+    ('gas', 1000),
+    ('brake', 1000),
+    ('clutch', 1000),
+    ('gear', 1),
+    ('position', 1000000),
+    ('time', 1),
+)
+NULLABLE = ('position', 'time')
+
+# Channels of each version of the format, by magic string
+VERSIONS = {
+    b'RLZ1': CHANNELS[:-1],
+    COMPACT_MAGIC: CHANNELS,
+}
+
+
+def zigzag(value):
+    '''
+    Map signed integers to unsigned ones: 0, -1, 1, -2... to 0, 1, 2, 3...
+    '''
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_varint(value, out):
+    '''
+    Append the unsigned integer value to the bytearray out, 7 bits per byte
+    '''
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, offset):
+    '''
+    Returns the unsigned integer at offset in data and the offset after it
+    '''
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+def encode_points(points, first, out):
+    '''
+    Append the points of the PointArray from index 'first' to out,
+    channel by channel
+    '''
+    encode_varint(len(points) - first, out)
+    for name, scale in CHANNELS:
+        previous = 0
+        for value in getattr(points, name)[first:]:
+            if name in NULLABLE:
+                value = 0 if value != value else int(round(value * scale)) + 1
+            else:
+                value = int(round(value * scale))
+            encode_varint(zigzag(value - previous), out)
+            previous = value
+
+
+def decode_points(data, offset, channels=CHANNELS):
+    '''
+    Returns a dict of the points values by channel and the offset after them
+    '''
+    count, offset = decode_varint(data, offset)
+    result = {}
+    for name, scale in channels:
+        values = []
+        value = 0
+        for i in range(count):
+            delta, offset = decode_varint(data, offset)
+            value += unzigzag(delta)
+            values.append(value)
+
+        if name in NULLABLE:
+            result[name] = [(value - 1) / scale if value else None for value in values]
+        elif scale == 1:
+            result[name] = values
+        else:
+            result[name] = [value / scale for value in values]
+
+    return result, offset
+
+
+def encode_header(data):
+    '''
+    Returns the record for the session header dict
+    '''
+    payload = json.dumps(data).encode('utf-8')
+    out = bytearray([RECORD_HEADER])
+    encode_varint(len(payload), out)
+    out.extend(payload)
+    return out
+
+
+def encode_lap(count, invalid, laptime, points, first=0):
+    '''
+    Returns the record for a lap with its points from index 'first'
+    '''
+    out = bytearray([RECORD_LAP])
+    encode_varint(count, out)
+    encode_varint(int(invalid), out)
+    encode_varint(zigzag(int(laptime)), out)
+    encode_points(points, first, out)
+    return out
+
+
+def encode_chunk(count, points, first=0):
+    '''
+    Returns the record for points streamed during lap 'count'
+    '''
+    out = bytearray([RECORD_CHUNK])
+    encode_varint(count, out)
+    encode_points(points, first, out)
+    return out
+
+
+def encode_drop(count):
+    out = bytearray([RECORD_DROP])
+    encode_varint(count, out)
+    return out
+
+
+def decode_records(data, channels=CHANNELS):
+    '''
+    Yield the records in the (uncompressed) data as (type, fields, points),
+    an incomplete record at the end is ignored. channels are the points
+    channels of the file's version, see VERSIONS
+    '''
+    offset = 0
+    while offset < len(data):
+        try:
+            kind = data[offset]
+            offset += 1
+            if kind == RECORD_HEADER:
+                size, offset = decode_varint(data, offset)
+                if offset + size > len(data):
+                    return
+                fields = json.loads(data[offset:offset + size].decode('utf-8'))
+                offset += size
+                yield kind, fields, None
+            elif kind == RECORD_LAP:
+                count, offset = decode_varint(data, offset)
+                invalid, offset = decode_varint(data, offset)
+                laptime, offset = decode_varint(data, offset)
+                points, offset = decode_points(data, offset, channels)
+                yield kind, {'count': count, 'invalid': invalid,
+                             'laptime': unzigzag(laptime)}, points
+            elif kind == RECORD_CHUNK:
+                count, offset = decode_varint(data, offset)
+                points, offset = decode_points(data, offset, channels)
+                yield kind, {'count': count}, points
+            elif kind == RECORD_DROP:
+                count, offset = decode_varint(data, offset)
+                yield kind, {'count': count}, None
+            else:
+                raise ValueError('Unknown record type %d' % kind)
+        except IndexError:
+            # Truncated record
+            return
+
+
+class CompactWriter(object):
+    '''
+    Writes records to a compact file, each record is flushed so the file
+    can be read up to the last record if the writing stops unexpectedly
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.compressor = None
+        if f.tell() == 0:
+            f.write(COMPACT_MAGIC)
+
+    def write(self, record, end=False):
+        '''
+        Write the record, if end is True the zlib stream is ended and the
+        next record starts a new one
+        '''
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(9)
+        data = self.compressor.compress(bytes(record))
+        if end:
+            data += self.compressor.flush()
+            self.compressor = None
+        else:
+            data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.f.write(data)
+        self.f.flush()
+
+    def close(self):
+        '''
+        End the zlib stream, the file itself isn't closed
+        '''
+        if self.compressor is not None:
+            self.f.write(self.compressor.flush())
+            self.f.flush()
+            self.compressor = None
+
+
+def compress(record):
+    '''
+    Returns the record as a whole zlib stream, to be written to a compact
+    file where a stream starts
+    '''
+    return zlib.compress(bytes(record), 9)
+
+
+def decompress(data):
+    '''
+    Returns the records of a whole zlib stream, see compress
+    '''
+    return zlib.decompress(data)
+
+
+def read_streams(f, offset=len(COMPACT_MAGIC)):
+    '''
+    Yield the zlib streams of the compact file f as (offset, data), offset
+    being the position of the stream in the file. Reading starts at offset,
+    which must be the start of a stream, by default the first one
+    The last stream can be unfinished if the writing stopped unexpectedly
+    '''
+    f.seek(offset)
+
+    data = b''
+    while True:
+        start = offset
+        decompressor = zlib.decompressobj()
+        result = []
+        while not decompressor.eof:
+            if not data:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+            try:
+                result.append(decompressor.decompress(data))
+            except zlib.error:
+                # Corrupted, keep what we have
+                data = b''
+                break
+            offset += len(data) - len(decompressor.unused_data)
+            data = decompressor.unused_data
+
+        if result:
+            yield start, b''.join(result)
+        if not decompressor.eof:
+            return
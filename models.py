@@ -12,13 +12,29 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # Copyright (C) 2014 - Mathias Andre
 
-from acpmf import AcSharedMemory
+from acpmf import AcSharedMemory, AC_PHYSICS, AC_GRAPHICS
+from stats import Stats
+import codec
 
+from array import array
+from collections import OrderedDict
 from datetime import datetime
+import bisect
 import json
 import math
+import operator
 import os
+import queue
+import struct
 import sys
+import tempfile
+import threading
+
+try:
+    import numpy
+except ImportError:
+    # numpy isn't available in AC, we use pure Python then
+    numpy = None
 
 # colors:
 RED = (1, 0, 0, 1)
@@ -26,6 +42,32 @@ GREEN = (0, 1, 0, 1)
 WHITE = (0, 1, 0, 1)
 GREY_30 = (0.3, 0.3, 0.3, 1)
 GREY_60 = (0.6, 0.6, 0.6, 1)
+BLUE = (0.2, 0.5, 1, 1)
+
+# Colours of the current lap's points by class, see color_class
+SAME, SLOWER, FASTER = 0, 1, 2
+LAP_COLORS = (GREEN, RED, WHITE)
+SPEED_MARGIN = 2    # km/h, to avoid flickering between colours
+
+# Simplified versions of completed laps, the tolerances are in metres
+LOD_TOLERANCES = (0.25, 0.5, 1.0, 2.0, 4.0)
+LOD_PIXELS = 0.5    # Maximum error allowed when rendering, in pixels
+
+# Binary best lap format: a header followed by one array per channel
+BEST_LAP_MAGIC = b'RLBL'
+BEST_LAP_VERSION = 2
+# magic, version, invalid, lap count, number of points, laptime
+BEST_LAP_HEADER = struct.Struct('<4sHHIIi')
+BEST_LAP_CHANNELS = ('x', 'y', 'z', 'speed', 'gas', 'brake', 'clutch', 'gear', 'position', 'time')
+# Channels saved by each version, points didn't have a time in version 1
+BEST_LAP_VERSIONS = {
+    1: BEST_LAP_CHANNELS[:-1],
+    2: BEST_LAP_CHANNELS,
+}
+
+# Updates kept in the ring buffer
+RING_FIELDS = ('x', 'y', 'z', 'speed', 'gas', 'brake', 'clutch', 'gear', 'position', 'time')
+RING_RECORD = struct.Struct('<7fb2f')
 
 
 class Session(object):
@@ -48,16 +90,27 @@ class Session(object):
         self.app_size_x = 0
         self.app_size_y = 0
         self.save_data = False
+        self.export_format = 'json'     # See EXPORT_FORMATS
+        self.stream_export = False  # Export points during the lap, see stream_points
+        self.export_chunk_size = 64     # Maximum number of points to stream at once
+        self.export_chunk_time = 5.0    # Maximum time between streamed chunks (s)
+        self.export_file = None     # Only used by the writer thread
         self.start_time = datetime.now()
         self.current_data = {}
-        self.delta = 0.0    # Time since last data update
-        self.freq = 0.5
-        self.laps = []      # This is only used when running outside of AC
+        self.data_changed = False   # Whether update_data got new data since last render
+        self.sampler = Sampler()    # Decides when to record a new point
+        self.ring = RingBuffer()    # All the recent updates, see update_data
         self.zoom = 1.0     # Current zoom level
-
-    def _best_lap_path(self):
+        self.telemetry = Telemetry()
+        self.writer = Writer(self)
+        self.laps = LapStore(self, writer=self.writer)  # Completed laps, see new_lap
+        self.stats = Stats(self.writer)     # Timing of the callbacks, see stats
+        self.cars = Cars(self)      # The other cars, disabled by default
+        self.overlay_car = None     # Id of the car whose best lap is shown
+
+    def _best_lap_path(self, extension='lap'):
         '''
-        Returns the path to the best lap JSON file
+        Returns the path to the best lap file, binary by default
         Create the best lap directory if it doesn't already exists
         '''
         if not (self.trackname and self.carname):
@@ -71,27 +124,58 @@ class Session(object):
             self.console('Can\'t create directories "%s": %s' % (dirpath, e))
             return None
 
-        return os.path.join(dirpath, '%s.json' % self.carname)
+        return os.path.join(dirpath, '%s.%s' % (self.carname, extension))
 
     def load_best_lap(self):
         '''
         Checks if a best lap for the current track/car exists and loads it
+        Best laps saved as JSON by older versions are converted first
         '''
         path = self._best_lap_path()
+        if not path:
+            return
+
+        json_path = self._best_lap_path('json')
+        if not os.path.exists(path) and os.path.exists(json_path):
+            try:
+                convert_best_lap(json_path, path)
+            except Exception as e:
+                self.console('Can\'t convert file "%s": %s' % (json_path, e))
+                return
 
         if not os.path.exists(path):
             return
 
         try:
-            f = open(path)
+            f = open(path, 'rb')
         except Exception as e:
             self.console('Can\'t open file "%s": %s' % (path, e))
             return
 
-        self.best_lap = Lap(self, 0)
-        data = json.loads(f.read())
-        self.best_lap.json_loads(data)
-        f.close()
+        lap = Lap(self, 0)
+        try:
+            lap.binary_loads(f.read())
+        except ValueError as e:
+            self.console('Can\'t read file "%s": %s' % (path, e))
+            return
+        finally:
+            f.close()
+
+        # The indexes are slow to build, see Lap.prepare
+        self.best_lap = lap
+        self.writer.submit(lap.prepare)
+
+    def shutdown(self):
+        '''
+        Called when AC closes the app, writes the pending files and releases
+        the shared memory
+        '''
+        self.writer.close()
+        if self.export_file:
+            self.export_file.close()
+            self.export_file = None
+        self.telemetry.close()
+        self.laps.close()
 
     def console(self, msg):
         '''
@@ -108,17 +192,25 @@ class Session(object):
         '''
         self.best_lap = self.current_lap
 
+        # Build the indexes and write the file in the background
+        self.writer.submit(self.best_lap.prepare)
+        self.writer.submit(self._write_best_lap, self.best_lap.snapshot())
+
+    def _write_best_lap(self, lap):
+        '''
+        Write the given lap to the best lap file, called by the writer thread
+        '''
         path = self._best_lap_path()
         if not path:
             return
 
         try:
-            f = open(path, 'w')
+            f = open(path, 'wb')
         except Exception as e:
             self.console('Can\'t open file "%s" for writing: %s' % (path, e))
             return
 
-        f.write(self.best_lap.json_dumps() + '\n')
+        f.write(lap.binary_dumps())
         f.close()
 
     def new_lap(self, count, drop=False):
@@ -143,6 +235,7 @@ class Session(object):
                 return True
             return False
 
+        exported = False
         if not drop:
             # Check if current_lap is faster than previous best
             if is_best_lap(self.current_lap, self.best_lap):
@@ -151,9 +244,20 @@ class Session(object):
             # Save the current lap to file if necessary
             if self.save_data:
                 self.export_data()
+                exported = True
+
+            # Keep the lap, older laps are moved out of memory
+            if self.current_lap and self.current_lap.points:
+                self.laps.append(self.current_lap)
 
-        # Create new lap
+        if not exported and self.current_lap and self.current_lap.exported:
+            # Part of the lap was already streamed to the export file (the
+            # lap is dropped or the export was turned off since)
+            self.writer.submit(self._write_drop, self.current_lap.count)
+
+        # Create new lap, its first point is recorded straight away
         self.current_lap = Lap(self, count)
+        self.sampler.reset()
 
     def _get_wheels_lock(self):
         wheel_angular_speed = self.current_data['wheel_angular_speed']
@@ -177,6 +281,15 @@ class Session(object):
         '''
         Called by acUpdate, updates internal data
         '''
+        # Nothing to do if the simulation didn't advance since last time
+        # (paused, replay stalled, etc.)
+        start = self.stats.start()
+        updated = self.telemetry.update()
+        self.stats.stop('read', start)
+        if not updated:
+            return
+        self.data_changed = True
+
         # Check if we're in a new lap
         lap_count = self.ac.getCarState(0, self.acsys.CS.LapCount)
         lap_time = self.ac.getCarState(0, self.acsys.CS.LapTime)
@@ -190,6 +303,8 @@ class Session(object):
                 # Not all splits are valid, there was a restart, etc. we can drop
                 # the previous lap
                 self.new_lap(lap_count, drop=True)
+                # AC may have recreated the shared memory on restart
+                self.telemetry.reopen()
 
         # Update the status of the current lap
         self.current_lap.invalid = self.ac.getCarState(0, self.acsys.CS.LapInvalidated)
@@ -199,37 +314,49 @@ class Session(object):
         self.current_data['tyre_radius'] = self.ac.getCarState(0, self.acsys.CS.TyreRadius)
         self.current_data['wheel_angular_speed'] = self.ac.getCarState(0, self.acsys.CS.WheelAngularSpeed)
 
-        acshm = AcSharedMemory(7)
-        acshm.readValue("physics", "heading")
-        self.current_data['heading'] = math.pi - acshm.shm["physics"].memStruct["heading"]["val"]
+        self.current_data['heading'] = math.pi - self.telemetry.physics.heading
+
+        start = self.stats.start()
+        self.cars.update(deltaT)
+        self.stats.stop('cars', start)
         # wheelSlip is currently unused, left here for reference
-        # acshm.readValue("physics", "wheelSlip")
-        # self.current_data['wheels_slip'] = [ acshm.shm["physics"].memStruct["wheelSlip"]["val"]
+        # self.current_data['wheels_slip'] = self.telemetry.physics.wheelSlip
 
-        # We only update the rest of the data every FREQ seconds to
-        # prevent filling up the memory with data points
-        self.delta += deltaT
-        if self.delta < self.freq:
+        # Every update is kept in the ring buffer, see export_ring
+        physics = self.telemetry.physics
+        position = self.ac.getCarState(0, self.acsys.CS.WorldPosition)
+        track_position = self.ac.getCarState(0, self.acsys.CS.NormalizedSplinePosition)
+        self.ring.append(position[0], position[1], position[2],
+                         self.current_data['current_speed'], physics.gas, physics.brake,
+                         self.ac.getCarState(0, self.acsys.CS.Clutch), physics.gear,
+                         track_position, self.current_lap.laptime)
+
+        # We only record a point in the lap when the car moved or turned
+        # enough or the inputs changed to prevent filling up the memory
+        if not self.sampler.sample(deltaT, position, physics.heading,
+                                   physics.gas, physics.brake, physics.gear):
             return
-        self.delta = 0
 
-        # Get the current car's position and add it to current lap
-        position = self.ac.getCarState(0, self.acsys.CS.WorldPosition)
-        point = Point(*position)
-        point.speed = self.ac.getCarState(0, self.acsys.CS.SpeedKMH)
-        point.gas = self.ac.getCarState(0, self.acsys.CS.Gas)
-        point.brake = self.ac.getCarState(0, self.acsys.CS.Brake)
-        point.clutch = self.ac.getCarState(0, self.acsys.CS.Clutch)
-        point.gear = self.ac.getCarState(0, self.acsys.CS.Gear)
-
-        # If we have a best lap get the speed at the closest point
+        # Add the latest update to current lap
+        point = self.ring.point(-1)
+
+        # If we have a best lap get the speed at the same point of the track
+        # and the time difference with it
         if self.best_lap:
-            closest_point = self.best_lap.closest_point(point)
+            start = self.stats.start()
+            closest_point = self.current_lap.compare(point, self.best_lap)
             if closest_point:
                 point.best_speed = closest_point.speed
+                if self.best_lap.timing:
+                    self.current_data['delta'] = self.best_lap.timing.delta(
+                        point, closest_point.i, point.time)
+            self.stats.stop('compare', start)
 
         self.current_lap.points.append(point)
 
+        if self.save_data and self.stream_export:
+            self.stream_points()
+
     def render_tyres_slip(self):
         '''
         Render the tyres slip widget
@@ -250,13 +377,36 @@ class Session(object):
         '''
         Renders the widget
         '''
+        if 'heading' not in self.current_data:
+            # We don't have any data yet
+            return
         heading = self.current_data['heading']
 
+        # Centre the view on the car: the last recorded point can be up to
+        # Sampler.distance behind it
+        if len(self.ring):
+            reference = self.ring.point(-1)
+        else:
+            reference = self.current_lap.last_point
+
         if self.best_lap:
-            self.best_lap.render(self.current_lap.last_point, heading, GREY_60)
-            self.ac.setText(self.ui.labels['best_lap_time_val'], '%s' % self.best_lap.human_laptime())
+            self.best_lap.render(reference, heading, GREY_60)
+
+        overlay = self.cars.best_lap(self.overlay_car)
+        if overlay:
+            if overlay.levels_size != len(overlay.points):
+                overlay.simplify()
+            overlay.render(reference, heading, BLUE)
+
+        self.current_lap.render(reference, heading)
+
+        # The labels keep their values, only update them if we have new data
+        if not self.data_changed:
+            return
+        self.data_changed = False
 
-        self.current_lap.render(self.current_lap.last_point, heading)
+        if self.best_lap:
+            self.ac.setText(self.ui.labels['best_lap_time_val'], '%s' % self.best_lap.human_laptime())
 
         last_point = self.current_lap.last_point
         if not last_point:
@@ -276,8 +426,25 @@ class Session(object):
             else:
                 self.ac.setFontColor(current_speed_val_label, *WHITE)
 
+        # Time difference with the best lap at the same place on the track
+        delta = self.current_data.get('delta')
+        if delta is not None:
+            delta_val_label = self.ui.labels['delta_val']
+            self.ac.setText(delta_val_label, '%+.2f' % (delta / 1000))
+            self.ac.setFontColor(delta_val_label, *(RED if delta > 0 else GREEN))
+
         self.render_tyres_slip()
 
+    def next_overlay(self):
+        '''
+        Show the best lap of the next car which has one, or none after the
+        last one. Returns the name of the car
+        '''
+        self.overlay_car = self.cars.next_overlay(self.overlay_car)
+        if self.overlay_car is None:
+            return ''
+        return self.cars[self.overlay_car].name
+
     def zoom_in(self):
         '''
         Increase the current map zoom level
@@ -290,97 +457,424 @@ class Session(object):
         '''
         self.zoom /= 1.2
 
-    def json_dumps(self):
+    def header(self):
         '''
-        Returns a JSON representation of the Session
+        Returns the Session data saved in the export files
         '''
-        return json.dumps({
+        return {
             'trackname': self.trackname,
             'carname': self.carname,
-        })
+        }
+
+    def json_dumps(self):
+        '''
+        Returns a JSON representation of the Session
+        '''
+        return json.dumps(self.header())
 
     def export_data(self):
         '''
-        Export the Session data to a file in the plugin's directory
-        Returns the path to the file
+        Export the current lap to a file in the plugin's directory, the file
+        is written in the background. If the lap was streamed only the points
+        which haven't been exported yet are written
         '''
-        target_dir = os.path.join(self.app_path, 'exports')
+        lap = self.current_lap
+        if lap.exported:
+            # Include the last exported point as reference for the first one
+            self.writer.submit(self._write_export, lap.snapshot(lap.exported - 1), 1)
+        else:
+            self.writer.submit(self._write_export, lap.snapshot(), 0)
+        lap.exported = len(lap.points)
+
+    def stream_points(self):
+        '''
+        Export the points recorded since the previous call once we have
+        export_chunk_size of them or after export_chunk_time seconds, so we
+        don't lose the lap if AC crashes and don't write it all at lap end
+        '''
+        lap = self.current_lap
+        count = len(lap.points) - lap.exported
+        if not count:
+            return
+        if count < self.export_chunk_size and \
+           lap.laptime - lap.exported_time < self.export_chunk_time * 1000:
+            return
+
+        if lap.exported:
+            self.writer.submit(self._write_chunk, lap.snapshot(lap.exported - 1), 1)
+        else:
+            self.writer.submit(self._write_chunk, lap.snapshot(), 0)
+        lap.exported = len(lap.points)
+        lap.exported_time = lap.laptime
 
-        # Create the export directory if it doesn't already exists
+    def _export_path(self, time, extension):
+        '''
+        Returns the path of the export file started at the given time,
+        create the export directory if it doesn't already exists
+        '''
+        target_dir = os.path.join(self.app_path, 'exports')
         if not os.path.exists(target_dir):
             os.mkdir(target_dir)
 
-        filename = '%s-%s-%s.json' % (self.start_time.strftime('%Y-%m-%d-%H-%M-%S'),
-                                      self.trackname, self.carname)
+        filename = '%s-%s-%s.%s' % (time.strftime('%Y-%m-%d-%H-%M-%S'),
+                                    self.trackname, self.carname, extension)
+        return os.path.join(target_dir, filename)
+
+    def export_ring(self):
+        '''
+        Export all the updates kept in the ring buffer (rather than the
+        sampled points of the laps) to a new file, the file is written in
+        the background. The updates can span several laps, the lap time
+        is kept in the points
+        '''
+        count = self.current_lap.count if self.current_lap else 0
+        self.writer.submit(self._write_ring, self.ring.copy(), count, datetime.now())
+
+    def _write_ring(self, ring, count, time):
+        '''
+        Write the updates from the ring buffer to their own file, called by
+        the writer thread
+        '''
+        lap = Lap(self, count)
+        lap.invalid = 1
+        lap.points = ring.points()
 
+        export_class = EXPORT_FORMATS[self.export_format]
+        path = self._export_path(time, 'full.%s' % export_class.extension)
         try:
-            f = open(os.path.join(target_dir, filename), 'a')
+            f = open(path, export_class.mode)
         except Exception as e:
-            self.console('Can\'t open file "%s" for writing: %s' % (filename, e))
+            self.console('Can\'t open file "%s" for writing: %s' % (os.path.basename(path), e))
             return
 
+        export_file = export_class(f)
+        export_file.write_header(self)
+        export_file.write_lap(lap, 0)
+        export_file.close()
+        self.console('Saved %d updates to file %s.' % (len(lap.points), os.path.basename(path)))
+
+    def _open_export(self):
+        '''
+        Returns the export file, it is opened on first use and kept open for
+        the whole session. Called by the writer thread
+        Returns None if the file can't be opened
+        '''
+        if self.export_file is not None:
+            return self.export_file
+
+        export_class = EXPORT_FORMATS[self.export_format]
+        path = self._export_path(self.start_time, export_class.extension)
+        try:
+            f = open(path, export_class.mode)
+        except Exception as e:
+            self.console('Can\'t open file "%s" for writing: %s' % (os.path.basename(path), e))
+            return None
+
         # Check the position in the file, if we're at 0 then the file
         # is new and write the session headers
-        if f.tell() == 0:
-            f.write(self.json_dumps() + '\n')
+        new = f.tell() == 0
+        self.export_file = export_class(f)
+        if new:
+            self.export_file.write_header(self)
+        return self.export_file
 
-        # Write the current lap to file
-        f.write(self.current_lap.json_dumps() + '\n')
-        f.close()
+    def _write_export(self, lap, first=0):
+        '''
+        Append the given lap from point 'first' to the export file, called by
+        the writer thread
+        '''
+        export_file = self._open_export()
+        if export_file:
+            export_file.write_lap(lap, first)
+            self.console('Saved lap %d to file %s.' % (
+                lap.count, os.path.basename(export_file.f.name)))
+
+    def _write_chunk(self, lap, first):
+        '''
+        Append the points of the lap from 'first' to the export file as a
+        chunk, they will be part of the next lap record
+        '''
+        export_file = self._open_export()
+        if export_file:
+            export_file.write_chunk(lap, first)
 
-        self.console('Saved lap %d to file %s.' % (self.current_lap.count,
-                                                   filename))
+    def _write_drop(self, count):
+        '''
+        Mark the chunks of lap 'count' as dropped in the export file
+        '''
+        export_file = self._open_export()
+        if export_file:
+            export_file.write_drop(count)
 
     def import_data(self, filename):
         '''
         Import a session from file. This is not meant to be called in AC
         '''
-        try:
-            f = open(filename)
-        except Exception as e:
-            self.console('Can\'t open file "%s": %s' % (filename, e))
+        reader = ExportReader(filename, self)
+        header = reader.header()
+        if header is None:
             return
-
-        # Read session_data
-        data = f.readline()
-        data = json.loads(data)
-        for key, value in data.items():
+        for key, value in header.items():
             setattr(self, key, value)
 
-        # Read laps data
-        for i, line in enumerate(f):
-            lap = Lap(self, i)
-            data = json.loads(line)
-            lap.json_loads(data)
+        for lap in reader.laps(len(self.laps)):
             self.laps.append(lap)
 
 
-class Point(object):
-    def __init__(self, x, y, z, s=0, g=0, b=0, c=0, r=0):
-        self.x = round(x, 2)
-        self.y = round(y, 2)
-        self.z = round(z, 2)
-        self.speed = round(s, 2)      # Speed in Km/h
-        self.gas = g
-        self.brake = b
-        self.clutch = c
-        self.gear = r
-        self.best_speed = None  # Speed at the closet point
-                                # of the best lap if any
-        self.start = False  # Used to start a new line when rendering
-        self.end = False    # Used to end a line when rendering
+class Telemetry(object):
+    '''
+    Long lived access to AC's shared memory: the mappings are opened once
+    and kept for the whole session instead of being opened on every update
+    '''
+    def __init__(self, mode=AC_PHYSICS, factory=AcSharedMemory):
+        '''
+        factory is called with mode to create the shared memory object,
+        this lets us use other buffers than AC's when testing
+        The graphics section is only read if in mode, the app doesn't use it
+        as acpmf's layout of it doesn't match AC's
+        '''
+        self.mode = mode
+        self.factory = factory
+        self.shm = None
+        self.physics = None     # Last snapshot of the physics section
+        self.graphics = None    # Last snapshot of the graphics section
+
+    def open(self):
+        '''
+        Open the shared memory mappings if they aren't already
+        '''
+        if self.shm is None:
+            self.shm = self.factory(self.mode)
+
+    def close(self):
+        '''
+        Close the shared memory mappings if they are open
+        '''
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def reopen(self):
+        '''
+        Close and reopen the mappings, i.e. when AC restarts the session
+        '''
+        self.close()
+        self.open()
+
+    def _read(self, method, *args):
+        '''
+        Call the given AcSharedMemory method, reopen the mappings if needed
+        '''
+        if self.shm is None or self.shm.closed:
+            self.reopen()
+
+        try:
+            return getattr(self.shm, method)(*args)
+        except (ValueError, OSError):
+            # The mapping is gone (closed, AC restarted, etc.), try again once
+            self.reopen()
+            return getattr(self.shm, method)(*args)
+
+    def read_value(self, key, name):
+        '''
+        Returns the value 'name' from the 'key' section (physics, graphics, etc.)
+        '''
+        self._read('readValue', key, name)
+        return self.shm.shm[key].memStruct[name]['val']
+
+    def update(self):
+        '''
+        Take a new snapshot of the physics, returns False if the simulation
+        didn't advance since the previous one
+        '''
+        physics = self._read('snapshot', 'physics')
+        if physics is None:
+            return False
+        self.physics = physics
+
+        # The graphics are updated at a different rate, keep the previous
+        # snapshot if they didn't change
+        if self.mode & AC_GRAPHICS:
+            graphics = self._read('snapshot', 'graphics')
+            if graphics is not None:
+                self.graphics = graphics
+
+        return True
+
+
+class Car(object):
+    '''
+    Current and best laps of another car of the session. We only know what
+    AC gives the apps for every car: position, speed and lap times, so the
+    inputs of the points are left empty
+    '''
+    def __init__(self, session, car_id, name=''):
+        self.session = session
+        self.id = car_id
+        self.name = name
+        self.current_lap = None
+        self.best_lap = None
+        self.lap_count = None
+        self.partial = True     # Whether we missed the start of current lap
+        sampler = session.sampler
+        self.sampler = Sampler(sampler.tolerance, sampler.distance, sampler.inputs,
+                               sampler.max_gap, sampler.stationary)
+        self.position = None    # Position and heading when last read
+        self.heading = 0.0
+        self.read_time = 0.0    # Cars.time when last read
+
+    def new_lap(self, count, completed=False, laptime=None):
+        '''
+        Start a new lap, the previous one becomes the best lap if it was
+        completed faster
+        '''
+        lap = self.current_lap
+        if completed and lap and not self.partial and lap.points:
+            if laptime:
+                lap.laptime = laptime
+            # The lap is only simplified when shown, see Session.render
+            if self.best_lap is None or lap.laptime < self.best_lap.laptime:
+                self.best_lap = lap
+
+        self.current_lap = Lap(self.session, count)
+        self.lap_count = count
+        self.sampler.reset()
+
+    def update(self, deltaT, lap_count, laptime, last_laptime, position, speed,
+               track_position):
+        '''
+        Record the values read by Cars.update, deltaT is the time since the
+        car was last read
+        '''
+        if self.current_lap is None:
+            # We don't know when the car was last read, the lap is partial
+            self.new_lap(lap_count)
+        elif lap_count == self.lap_count + 1:
+            self.new_lap(lap_count, completed=True, laptime=last_laptime)
+            self.partial = False
+        elif lap_count != self.lap_count or laptime < self.current_lap.laptime:
+            # Restart, back to the pits, etc. the lap is only whole if it
+            # started since the car was last read
+            self.new_lap(lap_count)
+            self.partial = laptime > deltaT * 1000
+        self.current_lap.laptime = laptime
+
+        # The heading is the direction the car moved in
+        previous = self.position
+        if previous is not None:
+            dx = position[0] - previous[0]
+            dz = position[2] - previous[2]
+            if dx or dz:
+                self.heading = math.atan2(dx, dz)
+        self.position = position
+
+        if not self.sampler.sample(deltaT, position, self.heading, 0, 0, 0):
+            return
+        self.current_lap.points.append(Point(position[0], position[1], position[2],
+                                             speed, n=track_position, t=laptime))
+
+
+class Cars(object):
+    '''
+    The other cars of the session (the player's car is the session's). Each
+    tick only 'per_tick' cars are read, in turn, so the cost stays the same
+    whatever the number of cars; each car is read every count / per_tick ticks
+    '''
+    def __init__(self, session, per_tick=4):
+        self.session = session
+        self.enabled = False
+        self.per_tick = per_tick
+        self.cars = {}      # Car by id
+        self.next_id = 1    # Next car to read
+        self.time = 0.0     # Time since the start, in seconds
+
+    def __len__(self):
+        return len(self.cars)
+
+    def __getitem__(self, car_id):
+        return self.cars[car_id]
 
-        # List of attributes, and their JSON keys
-        self.keys = (
-            ('x', 'x'),
-            ('y', 'y'),
-            ('z', 'z'),
-            ('speed', 's'),
-            ('gas', 'g'),
-            ('brake', 'b'),
-            ('clutch', 'c'),
-            ('gear', 'r'),
-        )
+    def schedule(self, count):
+        '''
+        Returns the ids of the cars to read this tick, out of 'count' cars
+        '''
+        ids = []
+        for n in range(min(self.per_tick, count - 1)):
+            if self.next_id >= count:
+                self.next_id = 1
+            ids.append(self.next_id)
+            self.next_id += 1
+        return ids
+
+    def update(self, deltaT):
+        '''
+        Called by Session.update_data, read and record the next cars
+        '''
+        if not self.enabled:
+            return
+        self.time += deltaT
+        ac = self.session.ac
+        cs = self.session.acsys.CS
+
+        # Read everything first, then record it
+        reads = []
+        for car_id in self.schedule(ac.getCarsCount()):
+            if not ac.isConnected(car_id):
+                continue
+            reads.append((car_id,
+                          ac.getCarState(car_id, cs.LapCount),
+                          ac.getCarState(car_id, cs.LapTime),
+                          ac.getCarState(car_id, cs.LastLap),
+                          ac.getCarState(car_id, cs.WorldPosition),
+                          ac.getCarState(car_id, cs.SpeedKMH),
+                          ac.getCarState(car_id, cs.NormalizedSplinePosition)))
+
+        for car_id, lap_count, laptime, last_laptime, position, speed, track_position in reads:
+            car = self.cars.get(car_id)
+            if car is None:
+                car = self.cars[car_id] = Car(self.session, car_id, ac.getDriverName(car_id))
+                car.read_time = self.time - deltaT
+            car.update(self.time - car.read_time, lap_count, laptime, last_laptime,
+                       position, speed, track_position)
+            car.read_time = self.time
+
+    def next_overlay(self, car_id=None):
+        '''
+        Returns the id of the car after car_id which has a best lap, or None
+        after the last one
+        '''
+        for other_id in sorted(self.cars):
+            if (car_id is None or other_id > car_id) and self.cars[other_id].best_lap:
+                return other_id
+        return None
+
+    def best_lap(self, car_id):
+        '''
+        Returns the best lap of the given car if any
+        '''
+        car = self.cars.get(car_id)
+        return car.best_lap if car else None
+
+
+class BasePoint(object):
+    '''
+    Methods shared by Point and PointView
+    '''
+    __slots__ = ()
+
+    # List of attributes, and their JSON keys
+    keys = (
+        ('x', 'x'),
+        ('y', 'y'),
+        ('z', 'z'),
+        ('speed', 's'),
+        ('gas', 'g'),
+        ('brake', 'b'),
+        ('clutch', 'c'),
+        ('gear', 'r'),
+        ('position', 'n'),
+        ('time', 't'),
+    )
 
     def __repr__(self):
         return 'x: %f, z: %f' % (self.x, self.z)
@@ -405,229 +899,1632 @@ class Point(object):
         return result
 
 
-class Line(object):
+class RingBuffer(object):
     '''
-    A line is a series of point, used to represent a lap or circuit
+    Fixed size buffer of the latest updates, packed as RING_RECORD in a
+    preallocated bytearray. Once full the oldest records are overwritten
     '''
-    def __init__(self, session):
-        self.session = session  # Reference to the current session
-        self.points = []
+    def __init__(self, size=8192):
+        self.size = size
+        self.data = bytearray(size * RING_RECORD.size)
+        self.count = 0      # Number of records appended since the start
 
-    @property
-    def last_point(self):
-        '''
-        Returns the last point from the line
-        '''
-        try:
-            return self.points[-1]
-        except IndexError:
-            # This can happen before the first lap is recorded, but also happens
-            # "randomly" at given points on the track...
-            # so we check if we actually have points.
-            # Note that this is a dirty hack and it SHOULDN'T work! (but it does)
-            if self.points:
-                return self.points[-1]
-            return None
+    def __len__(self):
+        return min(self.count, self.size)
 
-    def normalise(self, reference_point, heading):
+    def append(self, x, y, z, speed, gas, brake, clutch, gear, position, time):
         '''
-        Return a normalised version of the points based on the widget
-        size, zoom level, the given reference point and current heading
+        Add a record, position is NaN if unknown
         '''
-        result = []
+        RING_RECORD.pack_into(self.data, (self.count % self.size) * RING_RECORD.size,
+                              x, y, z, speed, gas, brake, clutch, gear, position, time)
+        self.count += 1
 
-        if not reference_point:
-            # We don't have any data yet
-            return []
+    def clear(self):
+        self.count = 0
 
-        # Calculate the shift to fit the points within the widget
-        if reference_point.x > self.session.app_size_x / 2:
-            diff_x = -(reference_point.x - self.session.app_size_x / 2)
-        else:
-            diff_x = self.session.app_size_x / 2 - reference_point.x
-        if reference_point.z > self.session.app_size_y / 2:
-            diff_z = -(reference_point.z - self.session.app_size_y / 2)
-        else:
-            diff_z = self.session.app_size_y / 2 - reference_point.z
+    def copy(self):
+        ring = RingBuffer(self.size)
+        ring.data[:] = self.data
+        ring.count = self.count
+        return ring
 
-        # Shift the points, only keep the one that actually fit
-        # in the widget
-        out = False  # Whether or not the last point was outside the widget
-        for point in self.points:
-            # Rotate the point by 'heading' rad around the center (last point)
-            x = math.cos(heading) * (point.x - reference_point.x) - math.sin(heading) * (point.z - reference_point.z) + reference_point.x
-            z = math.sin(heading) * (point.x - reference_point.x) + math.cos(heading) * (point.z - reference_point.z) + reference_point.z
-
-            x = x + diff_x
-            y = point.y  # We ignore y for now
-            z = z + diff_z
-
-            # Zoom in/out point:
-            # Takes the difference between the coordinate and the center point,
-            # multiply it by the zoom ratio and add to center coordinate
-            x = self.session.app_size_x / 2 + (x - self.session.app_size_x / 2) * self.session.zoom
-            z = self.session.app_size_y / 2 + (z - self.session.app_size_y / 2) * self.session.zoom
-
-            if x > self.session.app_size_x or x < 0 or \
-               z > self.session.app_size_y or z < 0:
-                out = True
-                if result:
-                    result[-1].end = True
-                continue
+    def record(self, i):
+        '''
+        Returns record i as a tuple of RING_FIELDS, from the oldest kept
+        record, negative values count from the latest
+        '''
+        length = len(self)
+        if i < 0:
+            i += length
+        if not 0 <= i < length:
+            raise IndexError('Ring buffer index out of range')
+        i = (self.count - length + i) % self.size
+        return RING_RECORD.unpack_from(self.data, i * RING_RECORD.size)
+
+    def point(self, i):
+        '''
+        Returns record i as a Point
+        '''
+        x, y, z, speed, gas, brake, clutch, gear, position, time = self.record(i)
+        return Point(x, y, z, speed, gas, brake, clutch, gear,
+                     None if position != position else position, time)
 
-            p = Point(x, y, z)
-            p.speed = point.speed
-            p.best_speed = point.best_speed
-            if out:
-                p.start = True
-                out = False
+    def points(self):
+        '''
+        Returns the records kept, from the oldest, as a PointArray
+        '''
+        columns = dict((name, []) for name in RING_FIELDS)
+        for i in range(len(self)):
+            for name, value in zip(RING_FIELDS, self.record(i)):
+                columns[name].append(value)
+        for name in ('x', 'y', 'z', 'speed'):
+            columns[name] = [round(value, 2) for value in columns[name]]
+        return PointArray.from_columns(columns)
 
-            result.append(p)
 
-        return result
+class Sampler(object):
+    '''
+    Decides which updates are recorded as points: we record a new point when
+    the line between the last point and the car would be more than
+    'tolerance' metres away from the path it followed (estimated from the
+    distance and heading change), when the car moved 'distance' metres, the
+    gas or brake changed by 'inputs' or the gear changed since the last
+    point, or 'max_gap' seconds after it
+    Nothing is recorded while the car doesn't move more than 'stationary' metres
+    '''
+    def __init__(self, tolerance=0.02, distance=30.0, inputs=0.2, max_gap=1.0,
+                 stationary=0.5):
+        self.tolerance = tolerance
+        self.distance = distance
+        self.inputs = inputs
+        self.max_gap = max_gap
+        self.stationary = stationary
+        self.last = None        # Values of the last recorded point
+        self.elapsed = 0.0      # Time since the last recorded point
+
+    def reset(self):
+        '''
+        Record the next update whatever its values
+        '''
+        self.last = None
 
-    def render(self, reference_point, heading, color=None):
+    def sample(self, deltaT, position, heading, gas, brake, gear):
         '''
-        Renders the lap using the given color (default to grey)
+        Returns True if a point should be recorded for these values
         '''
-        self.session.ac.glBegin(self.session.acsys.GL.LineStrip)
+        self.elapsed += deltaT
+        if self.last is not None:
+            last_position, last_heading, last_gas, last_brake, last_gear = self.last
+            moved = math.sqrt((position[0] - last_position[0]) ** 2 +
+                              (position[1] - last_position[1]) ** 2 +
+                              (position[2] - last_position[2]) ** 2)
+            if moved < self.stationary:
+                return False
 
-        for point in self.normalise(reference_point, heading):
-            if point.start:
-                self.session.ac.glBegin(self.session.acsys.GL.LineStrip)
+            # On an arc of length l turning by a radians the chord is about
+            # l * a / 8 away from the arc
+            turned = abs(heading - last_heading) % (2 * math.pi)
+            turned = min(turned, 2 * math.pi - turned)
+            if moved * turned / 8 < self.tolerance and moved < self.distance and \
+               abs(gas - last_gas) < self.inputs and \
+               abs(brake - last_brake) < self.inputs and gear == last_gear and \
+               self.elapsed < self.max_gap:
+                return False
 
-            self.session.ac.glVertex2f(point.x, point.z)
+        self.last = (tuple(position), heading, gas, brake, gear)
+        self.elapsed = 0.0
+        return True
 
-            if color:
-                self.session.ac.glColor4f(*color)
-            else:
-                self.session.ac.glColor4f(*GREY_30)
 
-            if point.end:
-                self.session.ac.glEnd()
+class Writer(object):
+    '''
+    Background thread writing files so the game thread doesn't wait for the
+    disk, and running other slow jobs. Jobs are run in order, errors are
+    reported on the session console
+    '''
+    def __init__(self, session, size=16):
+        self.session = session
+        self.queue = queue.Queue(size)
+        self.thread = None
 
-        self.session.ac.glEnd()
+    def submit(self, function, *args):
+        '''
+        Queue function(*args) to be run by the writer thread, the arguments
+        shouldn't be changed afterwards. Blocks if the queue is full
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='racingline-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+        self.queue.put((function, args))
+
+    def _run(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                if function is None:
+                    # We're closing
+                    return
+                start = self.session.stats.start()
+                function(*args)
+                self.session.stats.stop('export', start)
+            except Exception as e:
+                self.session.console('Error writing file: %s' % e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''
+        Wait for all the queued jobs to be done
+        '''
+        if self.thread is not None:
+            self.queue.join()
 
-    def svg_path(self):
+    def close(self):
         '''
-        Returns a SVG path version of the line
+        Run the pending jobs and stop the thread
         '''
-        path = 'M %f,%f' % (self.points[0].x, self.points[0].z)
+        if self.thread is None:
+            return
 
-        for point in self.points:
-            path += ' L %f,%f' % (point.x, point.z)
+        self.queue.put((None, ()))
+        self.thread.join()
+        self.thread = None
 
-        return path
 
-    def write_svg(self, filename, title=''):
-        '''
-        Write a SVG path of the line to filename
-        '''
-        data = '''
-<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 780 140" class="racing-line">
-    <title>%s</title>
+class JsonExport(object):
+    '''
+    Export file in JSON: the session header and each lap on their own line,
+    streamed laps are split in chunk lines before the lap line
+    '''
+    extension = 'json'
+    mode = 'a'
 
-    <path d="%s"
-            stroke="#000000"
-            fill="none"
-            class="racing-line-line" />
-</svg>
-''' % (title, self.svg_path())
+    def __init__(self, f):
+        self.f = f
 
-        try:
-            f = open(filename, 'w')
-        except Exception as e:
-            self.console('Can\'t open file "%s": %s' % (filename, e))
+    def write(self, line):
+        self.f.write(line + '\n')
+        # Flush so the data is on disk if AC crashes
+        self.f.flush()
 
-        f.write(data)
-        f.close()
+    def write_header(self, session):
+        self.write(session.json_dumps())
 
-    def closest_point(self, ref_point):
-        '''
-        Returns the point from the line closest to the given point
-        '''
-        distance = None
-        closest = None
-        for point in self.points:
-            d = (point.x - ref_point.x) ** 2 + \
-                (point.y - ref_point.y) ** 2 + \
-                (point.z - ref_point.z) ** 2
-            d = abs(d)
+    def write_lap(self, lap, first):
+        self.write(lap.json_dumps(first))
 
-            if distance is None or d < distance:
-                distance = d
-                closest = point
+    def write_chunk(self, lap, first):
+        self.write(json.dumps({
+            'chunk': lap.count,
+            'points': lap.points.dumps(first),
+        }))
 
-        return closest
+    def write_drop(self, count):
+        self.write(json.dumps({'drop': count}))
 
+    def close(self):
+        self.f.close()
 
-class Lap(Line):
-    def __init__(self, session, count):
-        Line.__init__(self, session)
-        self.count = count
-        self.invalid = 0
-        self.laptime = 0
 
-    def human_laptime(self):
+class CompactExport(JsonExport):
+    '''
+    Export file in the compressed binary format, see codec
+    '''
+    extension = 'rlz'
+    mode = 'ab'
+
+    def __init__(self, f):
+        JsonExport.__init__(self, f)
+        self.writer = codec.CompactWriter(f)
+
+    def write_header(self, session):
+        self.writer.write(codec.encode_header(session.header()), end=True)
+
+    def write_lap(self, lap, first):
+        self.writer.write(codec.encode_lap(lap.count, lap.invalid, lap.laptime,
+                                           lap.points, first), end=True)
+
+    def write_chunk(self, lap, first):
+        self.writer.write(codec.encode_chunk(lap.count, lap.points, first))
+
+    def write_drop(self, count):
+        self.writer.write(codec.encode_drop(count), end=True)
+
+    def close(self):
+        self.writer.close()
+        self.f.close()
+
+
+EXPORT_FORMATS = {
+    'json': JsonExport,
+    'compact': CompactExport,
+}
+
+
+class ExportReader(object):
+    '''
+    Reads an export file (JSON or compact) one lap at a time. The offset and
+    details of each lap are kept in an index file next to the export so
+    laps can be listed or read on their own without parsing the whole file
+    '''
+    INDEX_VERSION = 1
+
+    def __init__(self, filename, session=None):
+        self.filename = filename
+        self.session = session or Session()
+        self.index_path = filename + '.idx'
+        self._index = None
+
+    def _open(self):
+        try:
+            return open(self.filename, 'rb')
+        except Exception as e:
+            self.session.console('Can\'t open file "%s": %s' % (self.filename, e))
+            return None
+
+    def _records(self, f, offset=None):
         '''
-        Returns the laptime under the format: m:s.ms
+        Yield the records of the file from offset as (offset, type, data,
+        points), offset being where the record can be read from, type one of
+        codec's RECORD_* and points a PointArray for laps and chunks
+        offset must be the start of a lap, None reads the whole file
         '''
-        s, ms = divmod(self.laptime, 1000)
-        m, s = divmod(s, 60)
-        return '%d:%d.%d' % (m, s, ms)
+        channels = codec.VERSIONS.get(f.read(len(codec.COMPACT_MAGIC)))
+        if channels:
+            for start, data in codec.read_streams(f, offset or len(codec.COMPACT_MAGIC)):
+                for kind, fields, points in codec.decode_records(data, channels):
+                    if points is not None:
+                        points = PointArray.from_columns(points)
+                    yield start, kind, fields, points
+            return
 
-    def __repr__(self):
-        return '%d: %s%s' % (self.count, self.human_laptime(),
-                             '*' if self.invalid else '')
+        f.seek(offset or 0)
+        previous = {}
+        while True:
+            start = f.tell()
+            line = f.readline()
+            if not line:
+                return
+            try:
+                data = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # The last line can be incomplete if AC crashed
+                self.session.console('Ignoring invalid data in file "%s"' % self.filename)
+                return
+
+            if 'drop' in data:
+                previous = {}
+                yield start, codec.RECORD_DROP, {'count': data['drop']}, None
+                continue
+            if 'points' not in data:
+                yield start, codec.RECORD_HEADER, data, None
+                continue
 
-    def render(self, reference_point, heading, color=None):
+            # Points only have the data which changed since the previous one,
+            # which can be in the previous chunk
+            points = PointArray.loads(data.pop('points'), previous)
+
+            if 'chunk' in data:
+                yield start, codec.RECORD_CHUNK, {'count': data['chunk']}, points
+            else:
+                previous = {}
+                yield start, codec.RECORD_LAP, data, points
+
+    def _laps(self, offset=None, number=0):
         '''
-        Renders the lap, if no color is given we use green for fast sectors
-        and red for slow sectors, and all green if no best_speed is available
+        Yield the laps from offset as (offset, data, lap), data being the
+        lap record's fields. A lap being recorded when the file was last
+        written is returned as invalid
+        '''
+        f = self._open()
+        if f is None:
+            return
+
+        try:
+            # Streamed laps are split in chunks of points followed by the lap
+            # record with the remaining points. Chunks of another lap than
+            # the record's weren't dropped (i.e. older files), skip them
+            chunks = PointArray()
+            chunks_count = None
+            start = None
+            for position, kind, data, points in self._records(f, offset):
+                if kind == codec.RECORD_CHUNK:
+                    if start is None or data['count'] != chunks_count:
+                        chunks = PointArray()
+                        start = position
+                        chunks_count = data['count']
+                    chunks.extend(points)
+                elif kind == codec.RECORD_DROP:
+                    chunks = PointArray()
+                    start = None
+                elif kind == codec.RECORD_LAP:
+                    if start is not None and data.get('count') != chunks_count:
+                        chunks = PointArray()
+                        start = None
+                    lap = Lap(self.session, number)
+                    lap.invalid = data.get('invalid', 0)
+                    lap.laptime = data.get('laptime', 0)
+                    chunks.extend(points)
+                    lap.points = chunks
+                    yield position if start is None else start, data, lap
+                    chunks = PointArray()
+                    start = None
+                    number += 1
+
+            if chunks:
+                # Unfinished lap
+                lap = Lap(self.session, number)
+                lap.invalid = 1
+                lap.points = chunks
+                yield start, {}, lap
+        finally:
+            f.close()
+
+    def header(self):
+        '''
+        Returns the session header of the file or None if it can't be read
+        '''
+        f = self._open()
+        if f is None:
+            return None
+
+        try:
+            for offset, kind, data, points in self._records(f):
+                if kind == codec.RECORD_HEADER:
+                    return data
+                break
+        finally:
+            f.close()
+        return None
+
+    def laps(self, number=0):
+        '''
+        Yield the laps of the file one at a time, numbered from 'number'
+        '''
+        for offset, data, lap in self._laps(number=number):
+            yield lap
+
+    def index(self):
+        '''
+        Returns the list of laps in the file as dicts with their offset in
+        the file, lap count, laptime, invalid flag and number of points.
+        The index file is created or updated if the export changed since
         '''
-        self.session.ac.glBegin(self.session.acsys.GL.LineStrip)
+        if self._index is not None:
+            return self._index
 
-        for point in self.normalise(reference_point, heading):
-            if point.start:
-                self.session.ac.glBegin(self.session.acsys.GL.LineStrip)
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = None
 
-            self.session.ac.glVertex2f(point.x, point.z)
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            if data['version'] == self.INDEX_VERSION and data['size'] == size:
+                self._index = data['laps']
+                return self._index
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        self._index = []
+        for offset, data, lap in self._laps():
+            self._index.append({
+                'offset': offset,
+                'count': data.get('count'),
+                'laptime': lap.laptime,
+                'invalid': lap.invalid,
+                'points': len(lap.points),
+            })
+
+        if size is not None:
+            try:
+                with open(self.index_path, 'w') as f:
+                    json.dump({'version': self.INDEX_VERSION, 'size': size,
+                               'laps': self._index}, f)
+            except (IOError, OSError) as e:
+                self.session.console('Can\'t write file "%s": %s' % (self.index_path, e))
+
+        return self._index
+
+    def get_lap(self, number):
+        '''
+        Returns lap 'number' of the file, only this lap is read
+        '''
+        entry = self.index()[number]
+        for offset, data, lap in self._laps(entry['offset'], number):
+            return lap
 
-            if color:
-                self.session.ac.glColor4f(*color)
-            elif point.best_speed is not None:
-                if point.best_speed > point.speed + 2:
-                    self.session.ac.glColor4f(*RED)
-                elif point.best_speed < current_speed - 2:
-                    self.session.ac.glColor4f(*WHITE)
+
+class LapStore(object):
+    '''
+    The laps of the session with a bounded memory use: the 'recent' latest
+    laps and the session's current and best laps stay in memory, the others
+    only while they use less than 'budget' bytes in all, the least recently
+    used going first. Laps going out of memory are written to a temporary
+    compact file (see codec), through 'writer' if given, and read again
+    when accessed. Behaves like a list of laps
+    '''
+    WRITING = -1    # Offset of the laps waiting for the writer
+
+    def __init__(self, session, recent=5, budget=32 * 1024 * 1024, writer=None):
+        self.session = session
+        self.recent = recent
+        self.budget = budget
+        self.writer = writer
+        self.laps = []          # Each lap, or None if it's only in the file
+        self.offsets = []       # Offset of each lap in the file if written, or WRITING
+        self.sizes = []         # Size of each lap in the file
+        self.used = OrderedDict()   # Size of the laps in memory by index, least recently used first
+        self.resident_bytes = 0     # Sum of used
+        # Protects the file and the laps against the writer, the laps are
+        # encoded and decoded outside of it so the game thread doesn't wait
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __len__(self):
+        return len(self.laps)
+
+    def __iter__(self):
+        for i in range(len(self.laps)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.laps)
+        if not 0 <= i < len(self.laps):
+            raise IndexError('lap index out of range')
+
+        # The file is read and decoded without the lock, a pending write can
+        # drop the lap meanwhile but putting it back is fine
+        with self.lock:
+            lap = self.laps[i]
+        if lap is None:
+            lap = self._read(i)
+        with self.lock:
+            self.laps[i] = lap
+            evicted = self._use(i, lap)
+        self._write_laps(evicted)
+        return lap
+
+    def append(self, lap):
+        with self.lock:
+            self.laps.append(lap)
+            self.offsets.append(None)
+            self.sizes.append(None)
+            evicted = self._use(len(self.laps) - 1, lap)
+        self._write_laps(evicted)
+
+    def _use(self, i, lap):
+        '''
+        Count lap i as the most recently used, and move other laps out of
+        memory if we're over budget. Returns the laps to write to the file
+        (see _write_laps), called with the lock held
+        '''
+        self.resident_bytes -= self.used.pop(i, 0)
+        self.used[i] = lap.nbytes()
+        self.resident_bytes += self.used[i]
+
+        evicted = []
+        for j in list(self.used):
+            if self.resident_bytes <= self.budget:
+                break
+            if j != i and not self.pinned(j):
+                self.resident_bytes -= self.used.pop(j)
+                if self.offsets[j] == self.WRITING:
+                    # The pending write drops it
+                    pass
+                elif self.offsets[j] is not None:
+                    # Already in the file
+                    self.laps[j] = None
                 else:
-                    self.session.ac.glColor4f(*GREEN)
+                    self.offsets[j] = self.WRITING
+                    evicted.append((j, self.laps[j]))
+        return evicted
+
+    def pinned(self, i):
+        '''
+        Returns True if lap i must stay in memory
+        '''
+        lap = self.laps[i]
+        return i >= len(self.laps) - self.recent or lap is self.session.current_lap or \
+            lap is self.session.best_lap
+
+    def _write_laps(self, evicted):
+        '''
+        Write the evicted laps, through the writer if any. Called without
+        the lock as the writer can block when its queue is full
+        '''
+        for i, lap in evicted:
+            if self.writer:
+                self.writer.submit(self._write, i, lap)
             else:
-                self.session.ac.glColor4f(*GREEN)
+                self._write(i, lap)
+
+    def _write(self, i, lap):
+        '''
+        Write lap i to the file, and drop it unless it was used again since
+        '''
+        data = codec.compress(codec.encode_lap(lap.count, lap.invalid, lap.laptime,
+                                               lap.points))
+        with self.lock:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile()
+                self.file.write(codec.COMPACT_MAGIC)
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(data)
+            self.offsets[i] = offset
+            self.sizes[i] = len(data)
+            if i not in self.used:
+                self.laps[i] = None
+
+    def _read(self, i):
+        '''
+        Returns lap i read from the file
+        '''
+        with self.lock:
+            self.file.seek(self.offsets[i])
+            data = self.file.read(self.sizes[i])
+
+        for kind, fields, points in codec.decode_records(codec.decompress(data)):
+            lap = Lap(self.session, fields['count'])
+            lap.invalid = fields['invalid']
+            lap.laptime = fields['laptime']
+            lap.points = PointArray.from_columns(points)
+            return lap
+
+    def usage(self):
+        '''
+        Returns the number of laps, of laps in memory, and the bytes used in
+        memory and in the file
+        '''
+        with self.lock:
+            file_bytes = self.file.seek(0, os.SEEK_END) if self.file else 0
+        return {
+            'laps': len(self.laps),
+            'resident': len(self.used),
+            'resident_bytes': self.resident_bytes,
+            'file_bytes': file_bytes,
+        }
+
+    def close(self):
+        '''
+        Delete the file, the laps which were only in it are lost
+        '''
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
 
-            if point.end:
-                self.session.ac.glEnd()
 
-        self.session.ac.glEnd()
+class Point(BasePoint):
+    __slots__ = ('x', 'y', 'z', 'speed', 'gas', 'brake', 'clutch', 'gear',
+                 'position', 'time', 'best_speed', 'start', 'end')
 
-    def json_dumps(self):
+    def __init__(self, x, y, z, s=0, g=0, b=0, c=0, r=0, n=None, t=None):
+        self.x = round(x, 2)
+        self.y = round(y, 2)
+        self.z = round(z, 2)
+        self.speed = round(s, 2)      # Speed in Km/h
+        self.gas = g
+        self.brake = b
+        self.clutch = c
+        self.gear = r
+        self.position = n       # Normalised position on the track spline
+        self.time = t           # Lap time when the point was recorded (ms)
+        self.best_speed = None  # Speed at the closet point
+                                # of the best lap if any
+        self.start = False  # Used to start a new line when rendering
+        self.end = False    # Used to end a line when rendering
+
+
+# Columns of a PointArray: attribute, array typecode, whether the value is
+# rounded to 2 decimals (as in Point) and whether it can be None
+CHANNELS = (
+    ('x', 'f', True, False),
+    ('y', 'f', True, False),
+    ('z', 'f', True, False),
+    ('speed', 'f', True, False),
+    ('gas', 'f', False, False),
+    ('brake', 'f', False, False),
+    ('clutch', 'f', False, False),
+    ('gear', 'b', False, False),
+    ('position', 'f', False, True),
+    ('time', 'f', False, True),
+    ('best_speed', 'f', True, True),
+)
+NAN = float('nan')
+# Default values of the optional Point arguments, by JSON key
+POINT_DEFAULTS = (('s', 0), ('g', 0), ('b', 0), ('c', 0), ('r', 0), ('n', None), ('t', None))
+
+
+class PointArray(object):
+    '''
+    Columnar storage of points: one array per channel (see CHANNELS) instead
+    of one object per point. Behaves like a list of points: indexing returns
+    a PointView, slicing a new PointArray. None values are stored as NaN.
+    '''
+    def __init__(self, points=None):
+        self.columns = []
+        for name, typecode, rounded, nullable in CHANNELS:
+            column = array(typecode)
+            setattr(self, name, column)
+            self.columns.append(column)
+
+        if points:
+            self.extend(points)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        for i in range(len(self.x)):
+            yield PointView(self, i)
+
+    def nbytes(self):
+        '''
+        Returns the size of the points values in bytes
         '''
-        Returns a JSON representation of the Lap
+        return sum(column.itemsize * len(column) for column in self.columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            result = PointArray()
+            for name, typecode, rounded, nullable in CHANNELS:
+                getattr(result, name).extend(getattr(self, name)[key])
+            return result
+
+        count = len(self.x)
+        if key < 0:
+            key += count
+        if not 0 <= key < count:
+            raise IndexError('point index out of range')
+        return PointView(self, key)
+
+    def append(self, point):
         '''
-        points = []
-        for i, point in enumerate(self.points):
-            # We check if we have a previous point to only dump
-            # the data which has changed
-            if i > 0:
-                points.append(point.dumps(self.points[i - 1]))
+        Append a copy of the given point (Point or PointView)
+        '''
+        for (name, typecode, rounded, nullable), column in zip(CHANNELS, self.columns):
+            value = getattr(point, name)
+            column.append(NAN if value is None else value)
+
+    def extend(self, points):
+        if isinstance(points, PointArray):
+            for column, other in zip(self.columns, points.columns):
+                column.extend(other)
+            return
+
+        for point in points:
+            self.append(point)
+
+    @classmethod
+    def from_columns(cls, columns):
+        '''
+        Returns a PointArray with the values of columns, a dict of lists by
+        channel. Missing channels are filled with None (or 0)
+        '''
+        result = cls()
+        count = len(columns[CHANNELS[0][0]])
+        for (name, typecode, rounded, nullable), column in zip(CHANNELS, result.columns):
+            if name in columns:
+                values = columns[name]
+                if nullable:
+                    values = [NAN if value is None else value for value in values]
+                column.extend(values)
             else:
-                points.append(point.dumps())
+                column.extend(array(typecode, [NAN if nullable else 0]) * count)
+        return result
+
+    def dumps(self, first=0):
+        '''
+        Returns a list of dict representations of the points from 'first',
+        each point only has the data which changed since the previous one
+        (the point before 'first' is only used as reference)
+        '''
+        # Read the values like PointView does, one column at a time
+        channels = dict((channel[0], channel) for channel in CHANNELS)
+        start = first - 1 if first > 0 else first
+        shortnames = []
+        columns = []
+        for key, shortname in BasePoint.keys:
+            name, typecode, rounded, nullable = channels[key]
+            values = getattr(self, key)[start:].tolist()
+            if rounded:
+                values = [round(value, 2) for value in values]
+            if nullable:
+                values = [None if value != value else value for value in values]
+            shortnames.append(shortname)
+            columns.append(values)
+
+        # Compare each value with the one of the previous point
+        result = [{} for i in range(start, len(self))]
+        for shortname, values in zip(shortnames, columns):
+            previous = object()
+            for point, value in zip(result, values):
+                if value != previous:
+                    point[shortname] = value
+                previous = value
+
+        if first > 0:
+            # The point before 'first' was only used as reference
+            del result[0]
+        return result
+
+    @classmethod
+    def loads(cls, data, previous=None):
+        '''
+        Returns a PointArray from the dict representations given by dumps,
+        'previous' is the data of the point before if any, and is updated
+        with the data of the last point
+        '''
+        if previous is None:
+            previous = {}
+        # The default values of Point
+        for shortname, default in POINT_DEFAULTS:
+            previous.setdefault(shortname, default)
+        keys = [key for key, shortname in BasePoint.keys]
+        get = operator.itemgetter(*[shortname for key, shortname in BasePoint.keys])
+
+        rows = []
+        for point_data in data:
+            previous.update(point_data)
+            rows.append(get(previous))
+        if not rows:
+            return cls()
+
+        columns = dict(zip(keys, zip(*rows)))
+        for name, typecode, rounded, nullable in CHANNELS:
+            if rounded and name in columns:
+                columns[name] = [round(value, 2) for value in columns[name]]
+        return cls.from_columns(columns)
+
+    def take(self, indexes):
+        '''
+        Returns a new PointArray with the points at the given indexes
+        '''
+        result = PointArray()
+        for column, result_column in zip(self.columns, result.columns):
+            result_column.extend(column[i] for i in indexes)
+        return result
+
+
+class PointView(BasePoint):
+    '''
+    A point stored in a PointArray, attributes are read from and written to
+    the array's columns
+    '''
+    __slots__ = ('points', 'i')
+
+    start = False
+    end = False
+
+    def __init__(self, points, i):
+        self.points = points
+        self.i = i
+
+    def __eq__(self, other):
+        return isinstance(other, PointView) and \
+            self.points is other.points and self.i == other.i
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.points), self.i))
+
+
+def _channel_property(name, rounded, nullable):
+    '''
+    Returns a property reading/writing the given channel of a PointView
+    '''
+    def getter(self):
+        value = getattr(self.points, name)[self.i]
+        if nullable and value != value:
+            # NaN is used for None
+            return None
+        if rounded:
+            # The arrays are single precision, round back to the stored value
+            return round(value, 2)
+        return value
+
+    def setter(self, value):
+        getattr(self.points, name)[self.i] = NAN if value is None else value
+
+    return property(getter, setter)
+
+for _name, _typecode, _rounded, _nullable in CHANNELS:
+    setattr(PointView, _name, _channel_property(_name, _rounded, _nullable))
+
+
+class Line(object):
+    '''
+    A line is a series of point, used to represent a lap or circuit
+    '''
+    def __init__(self, session):
+        self.session = session  # Reference to the current session
+        self.points = PointArray()
+        self.index = None       # Spatial index of the points, see build_index
+        self.position_index = None  # Track position index, see build_index
+        self.render_cache = None    # Last result of transform
+        self.levels = []            # (tolerance, points) see simplify
+        self.levels_size = None     # Number of points when levels were built
+
+    @property
+    def last_point(self):
+        '''
+        Returns the last point from the line
+        '''
+        try:
+            return self.points[-1]
+        except IndexError:
+            # This can happen before the first lap is recorded, but also happens
+            # "randomly" at given points on the track...
+            # so we check if we actually have points.
+            # Note that this is a dirty hack and it SHOULDN'T work! (but it does)
+            if self.points:
+                return self.points[-1]
+            return None
+
+    def simplify(self):
+        '''
+        Build the simplified versions of the line used for rendering at low
+        zoom levels, this should be called once the line is complete
+        Each level is simplified from the previous one to keep this fast
+        '''
+        self.levels = []
+        points = self.points
+        for tolerance in LOD_TOLERANCES:
+            points = points.take(simplify_indexes(points.x, points.z, tolerance))
+            self.levels.append((tolerance, points))
+        self.levels_size = len(self.points)
+
+    def render_points(self):
+        '''
+        Returns the most simplified version of the points that can be
+        rendered at the current zoom level without visible difference
+        '''
+        points = self.points
+        if self.levels_size != len(points):
+            # Points were added since the levels were built
+            return points
+
+        for tolerance, level in self.levels:
+            if tolerance * self.session.zoom > LOD_PIXELS:
+                break
+            points = level
+        return points
+
+    def transform(self, reference_point, heading, points=None):
+        '''
+        Transform the points (default to all the line's points) to the widget
+        coordinates based on the widget size, zoom level, the given reference
+        point and current heading
+        Returns the lists of x and z coordinates and the visible segments as
+        (start, stop) index ranges
+        '''
+        if not reference_point:
+            # We don't have any data yet
+            return [], [], []
+        if points is None:
+            points = self.points
+
+        # Reuse the previous result if the view didn't change noticeably
+        cache = self.render_cache
+        view = (reference_point, heading, self.session.zoom,
+                self.session.app_size_x, self.session.app_size_y)
+        if cache is None or not cache.valid(points, *view):
+            transform = Transform(*view)
+            cache = self.render_cache = RenderCache(transform, points)
+        elif cache.count < len(points):
+            # Only new points were added, transform them
+            cache.extend()
+
+        return cache.xs, cache.zs, cache.segments
+
+    def normalise(self, reference_point, heading):
+        '''
+        Return a normalised version of the points based on the widget
+        size, zoom level, the given reference point and current heading
+        '''
+        result = []
+        xs, zs, segments = self.transform(reference_point, heading)
+        for start, stop in segments:
+            for i in range(start, stop):
+                point = self.points[i]
+                p = Point(xs[i], point.y, zs[i])  # We ignore y for now
+                p.speed = point.speed
+                p.best_speed = point.best_speed
+                result.append(p)
+
+            # Flag the points where the line goes in and out of the widget
+            if start > 0:
+                result[-(stop - start)].start = True
+            if stop < len(self.points):
+                result[-1].end = True
+
+        return result
 
+    def render(self, reference_point, heading, color=None):
+        '''
+        Renders the lap using the given color (default to grey)
+        '''
+        ac = self.session.ac
+        stats = self.session.stats
+        color = color or GREY_30
+        timer = stats.start()
+        xs, zs, segments = self.transform(reference_point, heading,
+                                          self.render_points())
+        stats.stop('normalise', timer)
+
+        timer = stats.start()
+        if segments:
+            # The colour applies to all the following vertices
+            ac.glColor4f(*color)
+        vertex = ac.glVertex2f
+        for start, stop in segments:
+            ac.glBegin(self.session.acsys.GL.LineStrip)
+            for i in range(start, stop):
+                vertex(xs[i], zs[i])
+            ac.glEnd()
+        stats.stop('gl', timer)
+
+    def svg_path(self):
+        '''
+        Returns a SVG path version of the line
+        '''
+        path = 'M %f,%f' % (self.points[0].x, self.points[0].z)
+
+        for point in self.points:
+            path += ' L %f,%f' % (point.x, point.z)
+
+        return path
+
+    def write_svg(self, filename, title=''):
+        '''
+        Write a SVG path of the line to filename
+        '''
+        data = '''
+<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 780 140" class="racing-line">
+    <title>%s</title>
+
+    <path d="%s"
+            stroke="#000000"
+            fill="none"
+            class="racing-line-line" />
+</svg>
+''' % (title, self.svg_path())
+
+        try:
+            f = open(filename, 'w')
+        except Exception as e:
+            self.console('Can\'t open file "%s": %s' % (filename, e))
+
+        f.write(data)
+        f.close()
+
+    def build_index(self):
+        '''
+        Build the indexes used by closest_point and comparable_point, this
+        should be called once the line is complete (i.e. for the best lap)
+        '''
+        self.index = GridIndex(self.points)
+        self.position_index = PositionIndex(self.points)
+
+    def comparable_point(self, ref_point, matcher=None):
+        '''
+        Returns the point from the line at the same place on the track as
+        the given point: using the track position if we know it, otherwise
+        the closest point, found by matcher if given
+        '''
+        if ref_point.position is not None and self.position_index and \
+           self.position_index.size == len(self.points):
+            return self.position_index.point_at(ref_point.position)
+
+        if matcher:
+            return matcher.closest_point(ref_point)
+        return self.closest_point(ref_point)
+
+    def closest_index(self, ref_point):
+        '''
+        Returns the index of the point from the line closest to the given point
+        '''
+        # Only use the index if no points were added since it was built
+        if self.index and self.index.size == len(self.points):
+            return self.index.closest_index(ref_point)
+
+        distance = None
+        closest = None
+        ref_x, ref_y, ref_z = ref_point.x, ref_point.y, ref_point.z
+        points = self.points
+        for i, (x, y, z) in enumerate(zip(points.x, points.y, points.z)):
+            d = (x - ref_x) ** 2 + (y - ref_y) ** 2 + (z - ref_z) ** 2
+
+            if distance is None or d < distance:
+                distance = d
+                closest = i
+
+        return closest
+
+    def closest_point(self, ref_point):
+        '''
+        Returns the point from the line closest to the given point
+        '''
+        i = self.closest_index(ref_point)
+        if i is None:
+            return None
+        return self.points[i]
+
+
+class Transform(object):
+    '''
+    Transform from world coordinates to the widget's: rotate by heading
+    around the reference point, centre it in the widget and zoom.
+    This is an affine transform so we precompute its coefficients:
+        x' = a * x + b * z + c
+        z' = d * x + e * z + f
+    '''
+    def __init__(self, reference_point, heading, zoom, size_x, size_y):
+        self.reference = (reference_point.x, reference_point.z)
+        self.heading = heading
+        self.zoom = zoom
+        self.size_x = size_x
+        self.size_y = size_y
+        cos = math.cos(heading) * zoom
+        sin = math.sin(heading) * zoom
+        self.a, self.b = cos, -sin
+        self.c = size_x / 2 - cos * reference_point.x + sin * reference_point.z
+        self.d, self.e = sin, cos
+        self.f = size_y / 2 - sin * reference_point.x - cos * reference_point.z
+
+    def distance(self, reference_point, heading, zoom, size_x, size_y):
+        '''
+        Returns how far (in pixels) the points within the widget could move
+        if we used the given view instead of this one
+        '''
+        if zoom != self.zoom or size_x != self.size_x or size_y != self.size_y:
+            return float('inf')
+
+        # The points in the widget are at most half its diagonal from the centre
+        radius = math.hypot(size_x, size_y) / 2
+        shift = math.hypot(reference_point.x - self.reference[0],
+                           reference_point.z - self.reference[1]) * zoom
+        return shift + abs(heading - self.heading) * radius
+
+    def apply(self, points, first=0):
+        '''
+        Transform the given PointArray from index 'first', returns the lists
+        of x and z coordinates and the segments of consecutive points within
+        the widget as (start, stop) index ranges in points
+        '''
+        if len(points) <= first:
+            return [], [], []
+        if numpy is not None:
+            return self._apply_numpy(points, first)
+
+        a, b, c, d, e, f = self.a, self.b, self.c, self.d, self.e, self.f
+        size_x, size_y = self.size_x, self.size_y
+        xs = []
+        zs = []
+        segments = []
+        start = None
+        for i, (x, z) in enumerate(zip(points.x[first:], points.z[first:]), first):
+            x, z = a * x + b * z + c, d * x + e * z + f
+            xs.append(x)
+            zs.append(z)
+            if 0 <= x <= size_x and 0 <= z <= size_y:
+                if start is None:
+                    start = i
+            elif start is not None:
+                segments.append((start, i))
+                start = None
+
+        if start is not None:
+            segments.append((start, len(points)))
+
+        return xs, zs, segments
+
+    def _apply_numpy(self, points, first):
+        x = numpy.frombuffer(points.x, dtype=numpy.float32)[first:].astype(numpy.float64)
+        z = numpy.frombuffer(points.z, dtype=numpy.float32)[first:].astype(numpy.float64)
+        xs = self.a * x + self.b * z + self.c
+        zs = self.d * x + self.e * z + self.f
+
+        visible = (xs >= 0) & (xs <= self.size_x) & (zs >= 0) & (zs <= self.size_y)
+        # Segments start and stop where visible changes
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], visible.view(numpy.int8), [0]))))
+        edges += first
+        segments = list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+        return xs.tolist(), zs.tolist(), segments
+
+
+class RenderCache(object):
+    '''
+    Transformed version of a line, it can be reused as long as the view
+    doesn't change by more than 'tolerance' pixels, and extended when
+    points are added to the line
+    '''
+    tolerance = 0.5
+
+    def __init__(self, transform, points):
+        self.transform = transform
+        self.points = points
+        self.count = len(points)
+        self.xs, self.zs, self.segments = transform.apply(points)
+
+    def valid(self, points, reference_point, heading, zoom, size_x, size_y):
+        '''
+        Returns True if the cache can be used for the given points and view
+        '''
+        if points is not self.points or len(points) < self.count:
+            return False
+        return self.transform.distance(reference_point, heading, zoom,
+                                       size_x, size_y) < self.tolerance
+
+    def extend(self):
+        '''
+        Transform the points added since the cache was computed
+        '''
+        xs, zs, segments = self.transform.apply(self.points, self.count)
+        self.xs.extend(xs)
+        self.zs.extend(zs)
+        if segments and self.segments and self.segments[-1][1] == segments[0][0]:
+            # The line was already visible, continue the last segment
+            self.segments[-1] = (self.segments[-1][0], segments[0][1])
+            segments = segments[1:]
+        self.segments.extend(segments)
+        self.count = len(self.points)
+
+
+class ColorRuns(object):
+    '''
+    Colours of the points of a lap as runs of consecutive points of the same
+    colour, so we only change the colour at the start of each run. Each
+    point's colour is only computed once, when extending the runs
+    '''
+    def __init__(self, points):
+        self.points = points
+        self.count = 0
+        self.starts = []    # Index of the first point of each run
+        self.colors = []    # Colour of each run, see LAP_COLORS
+        self.cache = None   # (segments, number of runs, strips) see strips
+        self.extend()
+
+    def extend(self):
+        '''
+        Add the points appended since the runs were computed
+        '''
+        points = self.points
+        speeds = points.speed
+        best_speeds = points.best_speed
+        starts = self.starts
+        colors = self.colors
+        last = colors[-1] if colors else None
+        for i in range(self.count, len(points)):
+            color = LAP_COLORS[color_class(speeds[i], best_speeds[i])]
+            if color != last:
+                starts.append(i)
+                colors.append(color)
+                last = color
+        self.count = len(points)
+
+    def strips(self, segments):
+        '''
+        Returns the given segments as lists of (start, stop, color) runs,
+        the result is reused while the segments and runs don't change
+        '''
+        cache = self.cache
+        if cache is not None and cache[0] == segments and cache[1] == len(self.starts):
+            return cache[2]
+
+        starts = self.starts
+        colors = self.colors
+        strips = []
+        for start, stop in segments:
+            strip = []
+            run = bisect.bisect_right(starts, start) - 1
+            while start < stop:
+                end = starts[run + 1] if run + 1 < len(starts) else stop
+                end = min(end, stop)
+                strip.append((start, end, colors[run]))
+                start = end
+                run += 1
+            strips.append(strip)
+
+        self.cache = (list(segments), len(starts), strips)
+        return strips
+
+
+class GridIndex(object):
+    '''
+    Uniform grid over the x/z coordinates of a list of points, it finds the
+    closest point by only looking at the cells around the reference point
+    '''
+    def __init__(self, points, cell_size=10.0):
+        self.points = points
+        self.size = len(points)
+        self.cell_size = cell_size
+        self.cells = {}     # (cell x, cell z): [(index, x, y, z), ...]
+
+        for i, (x, y, z) in enumerate(zip(points.x, points.y, points.z)):
+            cell = self._cell(x, z)
+            self.cells.setdefault(cell, []).append((i, x, y, z))
+
+        if self.cells:
+            self.min_x = min(x for x, z in self.cells)
+            self.max_x = max(x for x, z in self.cells)
+            self.min_z = min(z for x, z in self.cells)
+            self.max_z = max(z for x, z in self.cells)
+
+    def _cell(self, x, z):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(z / self.cell_size)))
+
+    def _ring(self, cx, cz, ring):
+        '''
+        Returns the cells at distance 'ring' around (cx, cz), ignoring those
+        outside of the grid
+        '''
+        if ring == 0:
+            return [(cx, cz)]
+
+        cells = []
+        xs = range(max(cx - ring, self.min_x), min(cx + ring, self.max_x) + 1)
+        for z in (cz - ring, cz + ring):
+            if self.min_z <= z <= self.max_z:
+                cells.extend((x, z) for x in xs)
+        zs = range(max(cz - ring + 1, self.min_z), min(cz + ring - 1, self.max_z) + 1)
+        for x in (cx - ring, cx + ring):
+            if self.min_x <= x <= self.max_x:
+                cells.extend((x, z) for z in zs)
+        return cells
+
+    def closest_index(self, ref_point):
+        '''
+        Returns the index of the closest point to ref_point, same as
+        Line.closest_index: the first one if several are at the same distance
+        '''
+        if not self.cells:
+            return None
+
+        cx, cz = self._cell(ref_point.x, ref_point.z)
+        max_ring = max(abs(cx - self.min_x), abs(cx - self.max_x),
+                       abs(cz - self.min_z), abs(cz - self.max_z))
+        distance = None
+        closest = None
+        for ring in range(max_ring + 1):
+            for cell in self._ring(cx, cz, ring):
+                for i, x, y, z in self.cells.get(cell, ()):
+                    d = (x - ref_point.x) ** 2 + \
+                        (y - ref_point.y) ** 2 + \
+                        (z - ref_point.z) ** 2
+                    if distance is None or d < distance or \
+                       (d == distance and i < closest):
+                        distance = d
+                        closest = i
+
+            # Points in the next rings are at least ring * cell_size away
+            if distance is not None and distance < (ring * self.cell_size) ** 2:
+                break
+
+        return closest
+
+
+class PositionIndex(object):
+    '''
+    The points of a line sorted by their normalised track position, points
+    at a given position are found by bisection
+    '''
+    def __init__(self, points):
+        self.points = points
+        self.size = len(points)
+        self.positions = []     # Sorted positions
+        self.indexes = []       # Index in points for each of the positions
+
+        # NaN is used when the line was recorded without track positions
+        if any(position != position for position in points.position):
+            return
+
+        for position, i in sorted((position, i) for i, position in enumerate(points.position)):
+            self.positions.append(position)
+            self.indexes.append(i)
+
+    def __bool__(self):
+        return bool(self.positions)
+    __nonzero__ = __bool__
+
+    def point_at(self, position):
+        '''
+        Returns the point with the nearest track position, the track
+        positions loop from 1 back to 0 at the start/finish line
+        '''
+        if not self.positions:
+            return None
+
+        i = bisect.bisect_left(self.positions, position)
+        closest = None
+        distance = None
+        # Check the points on both sides, wrapping around the start/finish
+        for j in (i - 1, i % len(self.positions)):
+            d = abs(self.positions[j] - position)
+            d = min(d, 1 - d)
+            if distance is None or d < distance:
+                distance = d
+                closest = j
+
+        return self.points[self.indexes[closest]]
+
+
+class Matcher(object):
+    '''
+    Finds the closest points of a reference line for consecutive samples:
+    each sample is close to the previous one so we first look around the
+    previous match and only search the whole line if that fails
+    '''
+    def __init__(self, reference, behind=5, ahead=15, max_distance=20.0):
+        self.reference = reference
+        self.behind = behind    # Number of points to check before the last match
+        self.ahead = ahead      # Number of points to check after the last match
+        self.max_distance = max_distance  # Further than this we search the whole line
+        self.last = None        # Index of the last match
+
+    def closest_index(self, ref_point):
+        '''
+        Returns the index of the point from the reference line closest to
+        the given point
+        '''
+        points = self.reference.points
+        count = len(points)
+        if self.last is not None and count > self.behind + self.ahead:
+            xs, ys, zs = points.x, points.y, points.z
+            distance = None
+            closest = None
+            for offset in range(-self.behind, self.ahead + 1):
+                # Laps are loops, wrap around the start/finish line
+                i = (self.last + offset) % count
+                d = (xs[i] - ref_point.x) ** 2 + \
+                    (ys[i] - ref_point.y) ** 2 + \
+                    (zs[i] - ref_point.z) ** 2
+                if distance is None or d < distance:
+                    distance = d
+                    closest = offset
+
+            # The match is wrong if it's too far (spin, reset, etc.) or on the
+            # edge of the window, as closer points may be outside of it
+            if distance <= self.max_distance ** 2 and \
+               -self.behind < closest < self.ahead:
+                self.last = (self.last + closest) % count
+                return self.last
+
+        self.last = self.reference.closest_index(ref_point)
+        return self.last
+
+    def closest_point(self, ref_point):
+        '''
+        Returns the point from the reference line closest to the given point
+        '''
+        i = self.closest_index(ref_point)
+        if i is None:
+            return None
+        return self.reference.points[i]
+
+
+class TimingTable(object):
+    '''
+    Distance driven and lap time at each point of a lap, used to find when
+    the lap reached any place of the track. The times are estimated from
+    the speed for laps recorded without them
+    '''
+    def __init__(self, lap):
+        points = lap.points
+        self.points = points
+        self.size = len(points)
+        self.distances = array('d')     # Cumulative distance at each point
+        self.times = array('d')         # Lap time at each point (ms)
+        if not self.size:
+            return
+
+        xs, ys, zs = points.x, points.y, points.z
+        distance = 0.0
+        self.distances.append(distance)
+        for i in range(1, self.size):
+            distance += math.sqrt((xs[i] - xs[i - 1]) ** 2 +
+                                  (ys[i] - ys[i - 1]) ** 2 +
+                                  (zs[i] - zs[i - 1]) ** 2)
+            self.distances.append(distance)
+
+        times = points.time
+        if any(time != time for time in times):
+            times = estimate_times(self.distances, points.speed, lap.laptime)
+
+        # The times must only go up to be searched
+        elapsed = 0.0
+        for time in times:
+            elapsed = max(elapsed, time)
+            self.times.append(elapsed)
+
+    def time_at(self, distance):
+        '''
+        Returns the lap time at the given distance, interpolated
+        '''
+        distances = self.distances
+        i = bisect.bisect_right(distances, distance)
+        if i == 0:
+            return self.times[0]
+        if i == self.size:
+            return self.times[-1]
+        ratio = (distance - distances[i - 1]) / (distances[i] - distances[i - 1])
+        return self.times[i - 1] + (self.times[i] - self.times[i - 1]) * ratio
+
+    def distance_at(self, point, i):
+        '''
+        Returns the distance of the lap at the given point, i being the
+        index of the lap's point closest to it. The point is projected on
+        the segment after or before that point
+        '''
+        points = self.points
+        xs, zs = points.x, points.z
+        for start in (i, i - 1):
+            end = start + 1
+            if start < 0 or end >= self.size:
+                continue
+            dx = xs[end] - xs[start]
+            dz = zs[end] - zs[start]
+            length = dx * dx + dz * dz
+            if not length:
+                continue
+            ratio = ((point.x - xs[start]) * dx + (point.z - zs[start]) * dz) / length
+            if 0 <= ratio <= 1:
+                return self.distances[start] + \
+                    (self.distances[end] - self.distances[start]) * ratio
+
+        return self.distances[i]
+
+    def delta(self, point, i, laptime):
+        '''
+        Returns the difference in ms between laptime and the time the lap took
+        to reach the given point (see distance_at), positive if slower
+        '''
+        if not self.size:
+            return None
+
+        delta = laptime - self.time_at(self.distance_at(point, i))
+        # Around the start/finish line the point can be matched with the
+        # other end of the lap
+        total = self.times[-1]
+        if delta > total / 2:
+            delta -= total
+        elif delta < -total / 2:
+            delta += total
+        return delta
+
+
+class Lap(Line):
+    def __init__(self, session, count):
+        Line.__init__(self, session)
+        self.count = count
+        self.invalid = 0
+        self.laptime = 0
+        self.matcher = None     # Used to compare the samples with a reference lap
+        self.color_runs = None  # Colours of the points, see render
+        self.timing = None      # Distance/time table, see build_index
+        self.exported = 0       # Number of points already exported
+        self.exported_time = 0  # laptime when points were last exported
+
+    def build_index(self):
+        '''
+        Build the indexes used to compare other laps with this one
+        '''
+        Line.build_index(self)
+        self.timing = TimingTable(self)
+
+    def prepare(self):
+        '''
+        Build the indexes and simplified versions of the lap (see
+        build_index and simplify) without changing the lap meanwhile, so
+        this can run in the writer thread while the lap is used: until
+        then comparisons use the slower search and rendering all the points
+        '''
+        lap = Lap(self.session, self.count)
+        lap.points = self.points
+        lap.build_index()
+        lap.simplify()
+
+        # They are only used when their size matches the points
+        self.index = lap.index
+        self.position_index = lap.position_index
+        self.timing = lap.timing
+        self.levels = lap.levels
+        self.levels_size = lap.levels_size
+
+    def compare(self, point, reference):
+        '''
+        Returns the point of the reference lap at the same place on the
+        track as the given point (which should be this lap's latest sample)
+        '''
+        if self.matcher is None or self.matcher.reference is not reference:
+            self.matcher = Matcher(reference)
+
+        return reference.comparable_point(point, self.matcher)
+
+    def snapshot(self, first=0):
+        '''
+        Returns a copy of the lap which won't be affected by later changes,
+        only with the points from 'first'
+        '''
+        lap = Lap(self.session, self.count)
+        lap.invalid = self.invalid
+        lap.laptime = self.laptime
+        lap.points = self.points[first:]
+        return lap
+
+    def nbytes(self):
+        '''
+        Returns the size of the points of the lap and of its simplified
+        versions in bytes
+        '''
+        return self.points.nbytes() + sum(points.nbytes() for tolerance, points in self.levels)
+
+    def human_laptime(self):
+        '''
+        Returns the laptime under the format: m:s.ms
+        '''
+        s, ms = divmod(self.laptime, 1000)
+        m, s = divmod(s, 60)
+        return '%d:%d.%d' % (m, s, ms)
+
+    def __repr__(self):
+        return '%d: %s%s' % (self.count, self.human_laptime(),
+                             '*' if self.invalid else '')
+
+    def render(self, reference_point, heading, color=None):
+        '''
+        Renders the lap, if no color is given we use green for fast sectors
+        and red for slow sectors, and all green if no best_speed is available
+        '''
+        if color:
+            return Line.render(self, reference_point, heading, color)
+
+        ac = self.session.ac
+        stats = self.session.stats
+        timer = stats.start()
+        points = self.render_points()
+        xs, zs, segments = self.transform(reference_point, heading, points)
+
+        # The colours only change when points are added
+        runs = self.color_runs
+        if runs is None or runs.points is not points or runs.count > len(points):
+            runs = self.color_runs = ColorRuns(points)
+        elif runs.count < len(points):
+            runs.extend()
+        strips = runs.strips(segments)
+        stats.stop('normalise', timer)
+
+        timer = stats.start()
+        vertex = ac.glVertex2f
+        for strip in strips:
+            ac.glBegin(self.session.acsys.GL.LineStrip)
+            for start, stop, color in strip:
+                ac.glColor4f(*color)
+                for i in range(start, stop):
+                    vertex(xs[i], zs[i])
+            ac.glEnd()
+        stats.stop('gl', timer)
+
+    def json_dumps(self, first=0):
+        '''
+        Returns a JSON representation of the Lap, with the points from
+        'first' (see PointArray.dumps)
+        '''
         return json.dumps({
             'count': self.count,
             'invalid': self.invalid,
             'laptime': self.laptime,
-            'points': points,
+            'points': self.points.dumps(first),
         })
 
     def json_loads(self, data):
@@ -639,16 +2536,61 @@ class Lap(Line):
         if 'laptime' in data:
             self.laptime = data['laptime']
 
-        previous = {}
-        for point_data in data['points']:
+        # Each point only has the data which changed since the previous one
+        self.points.extend(PointArray.loads(data['points']))
 
-            # Update the previous point_data with the current one, updated
-            # data will overwrite the old one, data which hasn't changed
-            # will be kept
-            previous.update(point_data)
+    def binary_dumps(self):
+        '''
+        Returns the binary representation of the Lap, see BEST_LAP_HEADER
+        '''
+        data = [BEST_LAP_HEADER.pack(BEST_LAP_MAGIC, BEST_LAP_VERSION,
+                                     int(self.invalid), self.count,
+                                     len(self.points), int(self.laptime))]
+        for name in BEST_LAP_CHANNELS:
+            column = getattr(self.points, name)
+            if sys.byteorder == 'big':
+                # The file is little endian
+                column = array(column.typecode, column)
+                column.byteswap()
+            data.append(column.tobytes())
+
+        return b''.join(data)
+
+    def binary_loads(self, data):
+        '''
+        Update the lap with the given binary data, raise ValueError if the
+        data isn't in the expected format
+        '''
+        if len(data) < BEST_LAP_HEADER.size:
+            raise ValueError('File is too short')
+        magic, version, invalid, count, size, laptime = BEST_LAP_HEADER.unpack_from(data)
+        if magic != BEST_LAP_MAGIC:
+            raise ValueError('Not a best lap file')
+        if version not in BEST_LAP_VERSIONS:
+            raise ValueError('Unsupported version %d' % version)
+        channels = BEST_LAP_VERSIONS[version]
+
+        self.invalid = invalid
+        self.count = count
+        self.laptime = laptime
+
+        offset = BEST_LAP_HEADER.size
+        for name, typecode, rounded, nullable in CHANNELS:
+            column = getattr(self.points, name)
+            if name not in channels:
+                # Not saved, fill the column to keep them aligned
+                column.extend(array(typecode, [NAN if nullable else 0]) * size)
+                continue
 
-            point = Point(**previous)
-            self.points.append(point)
+            end = offset + size * column.itemsize
+            if end > len(data):
+                raise ValueError('File is truncated')
+            values = array(typecode)
+            values.frombytes(data[offset:end])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            column.extend(values)
+            offset = end
 
 
 class Track(object):
@@ -658,6 +2600,97 @@ class Track(object):
         # set inner and outer track line as Line()
 
 
+def convert_best_lap(source, target):
+    '''
+    Convert a best lap file between the JSON and binary formats, the format
+    of each file is given by its extension (.json or other for binary)
+    '''
+    lap = Lap(None, 0)
+    if source.endswith('.json'):
+        with open(source) as f:
+            lap.json_loads(json.loads(f.read()))
+    else:
+        with open(source, 'rb') as f:
+            lap.binary_loads(f.read())
+
+    if target.endswith('.json'):
+        with open(target, 'w') as f:
+            f.write(lap.json_dumps() + '\n')
+    else:
+        with open(target, 'wb') as f:
+            f.write(lap.binary_dumps())
+
+
+def estimate_times(distances, speeds, laptime):
+    '''
+    Returns the lap time (ms) at each point, estimated from the cumulative
+    distances (m) and speeds (km/h) of the points and scaled to the laptime
+    '''
+    times = [0.0]
+    for i in range(1, len(distances)):
+        # Ignore speeds under 1 m/s as the car is stopped
+        speed = max((speeds[i] + speeds[i - 1]) / 2 / 3.6, 1.0)
+        times.append(times[-1] + (distances[i] - distances[i - 1]) / speed * 1000)
+
+    if laptime > 0 and times[-1] > 0:
+        scale = laptime / times[-1]
+        times = [time * scale for time in times]
+    return times
+
+
+def color_class(speed, best_speed):
+    '''
+    Returns SLOWER or FASTER if speed is slower or faster than best_speed
+    by more than SPEED_MARGIN, SAME otherwise or if best_speed is NaN
+    '''
+    if best_speed > speed + SPEED_MARGIN:
+        return SLOWER
+    if best_speed < speed - SPEED_MARGIN:
+        return FASTER
+    return SAME
+
+
+def simplify_indexes(xs, zs, tolerance):
+    '''
+    Douglas-Peucker simplification of the given line, returns the sorted
+    indexes of the points to keep so that no point is more than tolerance
+    away from the simplified line
+    '''
+    count = len(xs)
+    if count < 3:
+        return list(range(count))
+
+    keep = [0, count - 1]
+    tolerance = tolerance ** 2
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, z1 = xs[first], zs[first]
+        dx, dz = xs[last] - x1, zs[last] - z1
+        length = dx ** 2 + dz ** 2
+
+        distance = 0
+        furthest = None
+        for i in range(first + 1, last):
+            # Squared distance from the point to the segment first-last
+            px, pz = xs[i] - x1, zs[i] - z1
+            if length:
+                t = min(max((px * dx + pz * dz) / length, 0), 1)
+                px, pz = px - t * dx, pz - t * dz
+            d = px ** 2 + pz ** 2
+            if d > distance:
+                distance = d
+                furthest = i
+
+        if furthest is not None and distance > tolerance:
+            keep.append(furthest)
+            stack.append((first, furthest))
+            stack.append((furthest, last))
+
+    keep.sort()
+    return keep
+
+
 def get_color_from_ratio(ratio, fade_in=False, mode='yr'):
     '''
     Return a color based on ratio
@@ -12,7 +12,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # Copyright (C) 2014 - Mathias Andre
 
-from models import Session
+from models import RingBuffer, Sampler, Session
 
 import ac
 import acsys
@@ -21,8 +21,33 @@ import os
 import sys
 import traceback
 
-# Data points frequency in seconds
-FREQ = 0.125
+# A new data point is recorded when the line drawn would be more than
+# SAMPLE_TOLERANCE metres from the car's path, the car moved SAMPLE_DISTANCE
+# metres, gas or brake changed by SAMPLE_INPUTS or the gear changed, and at
+# least every SAMPLE_MAX_GAP seconds while moving (see models.Sampler)
+SAMPLE_TOLERANCE = 0.02
+SAMPLE_DISTANCE = 30.0
+SAMPLE_INPUTS = 0.2
+SAMPLE_MAX_GAP = 1.0
+# Number of updates kept at full rate, saved to their own export file with
+# the Full button (see Session.export_ring)
+RING_SIZE = 8192
+# Time the callbacks and report the statistics every STATS_INTERVAL seconds
+# to the AC log and to stats.txt, this can be changed in the widget
+STATS = False
+STATS_INTERVAL = 30.0
+# Record the laps of the other cars, to show their best line in the widget,
+# at most CARS_PER_TICK cars are read per update
+TRACK_CARS = True
+CARS_PER_TICK = 4
+# Completed laps kept in memory: the LAPS_RECENT latest ones, then older
+# ones up to LAPS_MEMORY bytes in all, the others are moved to a temporary file
+LAPS_RECENT = 5
+LAPS_MEMORY = 32 * 1024 * 1024
+# Write the exported laps to file while driving rather than at the end of laps
+STREAM_EXPORT = True
+# Export files format: 'compact' (compressed binary) or 'json'
+EXPORT_FORMAT = 'compact'
 
 app_size_x = 400
 app_size_y = 200
@@ -45,6 +70,13 @@ class UI(object):
 
         self._create_checkbox('export_data', 'Export', 70, 180,
                               10, 10, save_checkbox_callback)
+        self._create_checkbox('stats', 'Stats', 140, 180,
+                              10, 10, stats_checkbox_callback)
+
+        self._create_button('overlay', 210, 180, 30, 12, overlay_callback,
+                            border=1, text='Car')
+        self._create_button('export_ring', 70, 160, 30, 12, export_ring_callback,
+                            border=1, text='Full')
 
         self._create_button('zoomout', 370, 185, 10, 10, zoomout_callback,
                             texture='zoomout.png')
@@ -70,8 +102,8 @@ class UI(object):
         self.chkboxes[name] = checkbox
 
     def _create_button(self, name, x, y, size_x, size_y, callback,
-                       border=0, opacity=0, texture=None):
-        button = ac.addButton(self.widget, '')
+                       border=0, opacity=0, texture=None, text=''):
+        button = ac.addButton(self.widget, text)
         ac.setPosition(button, x, y)
         ac.setSize(button, size_x, size_y)
         ac.addOnClickedListener(button, callback)
@@ -85,9 +117,12 @@ class UI(object):
     def _create_labels(self):
         self._create_label('current_speed', 'Speed', 10, 30)
         self._create_label('best_speed', 'Best', 10, 50)
+        self._create_label('delta', 'Delta', 10, 70)
         self._create_label('current_speed_val', '', 60, 30)
         self._create_label('best_speed_val', '', 60, 50)
+        self._create_label('delta_val', '', 60, 70)
         self._create_label('best_lap_time_val', '', 5, 175)
+        self._create_label('overlay_val', '', 245, 175)
 
 
 def acMain(ac_version):
@@ -97,10 +132,25 @@ def acMain(ac_version):
     session = Session(ac, acsys)
     session.app_size_x = app_size_x
     session.app_size_y = app_size_y
-    session.freq = FREQ
+    session.sampler = Sampler(SAMPLE_TOLERANCE, SAMPLE_DISTANCE, SAMPLE_INPUTS,
+                              SAMPLE_MAX_GAP)
+    session.ring = RingBuffer(RING_SIZE)
+    session.stats.interval = STATS_INTERVAL
+    session.stats.output = ac.log
+    session.stats.path = os.path.join(session.app_path, 'stats.txt')
+    session.stats.enable(STATS)
+    session.laps.recent = LAPS_RECENT
+    session.laps.budget = LAPS_MEMORY
+    session.cars.enabled = TRACK_CARS
+    session.cars.per_tick = CARS_PER_TICK
+    session.stream_export = STREAM_EXPORT
+    session.export_format = EXPORT_FORMAT
     session.trackname = ac.getTrackName(0)
     session.carname = ac.getCarName(0)
 
+    # Open the shared memory once for the whole session
+    session.telemetry.open()
+
     # Initialise UI:
     ui = UI(session)
     session.ui = ui
@@ -117,23 +167,38 @@ def acMain(ac_version):
 def acUpdate(deltaT):
     global session
 
+    start = session.stats.start()
     try:
         session.update_data(deltaT)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         session.ac.console('RacingLine Error (logged to file)')
         session.ac.log(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+    session.stats.stop('update', start)
+    session.stats.tick()
+
+
+def acShutdown():
+    global session
+
+    try:
+        session.shutdown()
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        session.ac.log(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
 
 
 def onFormRender(deltaT):
     global session
 
+    start = session.stats.start()
     try:
         session.render()
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         session.ac.console('RacingLine Error (logged to file)')
         session.ac.log(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+    session.stats.stop('render', start)
 
 
 def save_checkbox_callback(name, state):
@@ -144,6 +209,22 @@ def save_checkbox_callback(name, state):
         session.save_data = False
 
 
+def stats_checkbox_callback(name, state):
+    global session
+    session.stats.enable(bool(state))
+
+
+def export_ring_callback(x, y):
+    global session
+    session.export_ring()
+
+
+def overlay_callback(x, y):
+    global session
+    name = session.next_overlay()
+    ac.setText(session.ui.labels['overlay_val'], name)
+
+
 def zoomin_callback(x, y):
     global session
     session.zoom_in()
@@ -0,0 +1,442 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Copyright (C) 2014 - Mathias Andre
+
+'''
+Run the app outside of AC by replaying an export file through the
+racingline.py callbacks, with stand-in ac and acsys modules and the shared
+memory in files. Reports the time taken by each frame and the peak memory.
+
+    python replay.py [--fps FPS] [--realtime] [--laps N] [--cars N] [-f FRAMES_CSV] EXPORT_FILE
+'''
+
+from acpmf import AcSharedMemory, AcPhysics
+from models import ExportReader, Session, Telemetry, TimingTable
+
+import argparse
+import bisect
+import csv
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import types
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FPS = 60.0
+
+
+class CarState(object):
+    '''
+    State of the car for the current frame, read by the stand-in ac module
+    '''
+    def __init__(self):
+        self.lap_count = 0
+        self.laptime = 0
+        self.last_laptime = 0
+        self.invalid = 0
+        self.position = (0.0, 0.0, 0.0)
+        self.track_position = 0.0
+        self.heading = 0.0
+        self.speed = 0.0
+        self.gas = 0.0
+        self.brake = 0.0
+        self.clutch = 0.0
+        self.gear = 1
+
+
+def fake_modules(cars):
+    '''
+    Returns the stand-in ac and acsys modules, ac reads the list of cars by
+    id, the first one is the player's (see CarState)
+    '''
+    acsys = types.ModuleType('acsys')
+    acsys.CS = types.SimpleNamespace(
+        LapCount='LapCount', LapTime='LapTime', LastLap='LastLap',
+        LapInvalidated='LapInvalidated', NormalizedSplinePosition='NormalizedSplinePosition',
+        SpeedKMH='SpeedKMH', TyreRadius='TyreRadius',
+        WheelAngularSpeed='WheelAngularSpeed', WorldPosition='WorldPosition',
+        Gas='Gas', Brake='Brake', Clutch='Clutch', Gear='Gear')
+    acsys.GL = types.SimpleNamespace(LineStrip=0, Lines=1, Triangles=2, Quads=3)
+
+    ac = types.ModuleType('ac')
+    ac.messages = []    # Console messages
+    ac.logs = []        # Log messages, the app logs its errors there
+    ac.gl_calls = 0
+    ac.listeners = {}   # Click callbacks by control
+    controls = []
+
+    def control(*args):
+        controls.append(args)
+        return len(controls)
+
+    def nothing(*args):
+        pass
+
+    def gl(*args):
+        ac.gl_calls += 1
+
+    for name in ('newApp', 'addLabel', 'addCheckBox', 'addButton'):
+        setattr(ac, name, control)
+    def listener(control, callback):
+        ac.listeners[control] = callback
+
+    ac.addOnClickedListener = listener
+    for name in ('setSize', 'addRenderCallback', 'setText', 'setPosition',
+                 'addOnCheckBoxChanged', 'drawBorder',
+                 'setBackgroundOpacity', 'setBackgroundTexture', 'setFontColor'):
+        setattr(ac, name, nothing)
+    for name in ('glBegin', 'glEnd', 'glVertex2f', 'glColor4f', 'glQuad'):
+        setattr(ac, name, gl)
+
+    ac.console = ac.messages.append
+    ac.log = ac.logs.append
+    ac.getTrackName = lambda car_id: cars[car_id].trackname
+    ac.getCarName = lambda car_id: cars[car_id].carname
+    ac.getDriverName = lambda car_id: 'Driver %d' % car_id
+    ac.getCarsCount = lambda: len(cars)
+    ac.isConnected = lambda car_id: 0 <= car_id < len(cars)
+    ac.getLastSplits = lambda car_id: [1, 1, 1]
+
+    # Wheels turn at the car's speed with 0.3m tyres
+    values = {
+        'LapCount': lambda car: car.lap_count,
+        'LapTime': lambda car: car.laptime,
+        'LastLap': lambda car: car.last_laptime,
+        'LapInvalidated': lambda car: car.invalid,
+        'NormalizedSplinePosition': lambda car: car.track_position,
+        'SpeedKMH': lambda car: car.speed,
+        'TyreRadius': lambda car: (0.3, 0.3, 0.3, 0.3),
+        'WheelAngularSpeed': lambda car: (car.speed / 3.6 / 0.3,) * 4,
+        'WorldPosition': lambda car: car.position,
+        'Gas': lambda car: car.gas,
+        'Brake': lambda car: car.brake,
+        'Clutch': lambda car: car.clutch,
+        'Gear': lambda car: car.gear,
+    }
+    ac.getCarState = lambda car_id, name, *args: values[name](cars[car_id])
+
+    return ac, acsys
+
+
+class SharedMemoryFiles(object):
+    '''
+    The physics section in a file named after its tag name,
+    mapped in memory and written with the values of each frame. The app maps
+    the files separately, as it would map AC's memory
+    '''
+    SECTIONS = (('physics', AcPhysics),)
+
+    def __init__(self, path):
+        self.files = {}
+        self.handles = {}
+        for key, section in self.SECTIONS:
+            f = open(os.path.join(path, section.tagname), 'w+b')
+            f.write(b'\0' * section.size)
+            f.flush()
+            self.files[key] = f
+            self.handles[key] = mmap.mmap(f.fileno(), section.size)
+        self.packet_id = 0
+
+    def factory(self, mode):
+        '''
+        Replaces AcSharedMemory in Telemetry, the mappings are closed with it
+        '''
+        handles = dict((key, mmap.mmap(self.files[key].fileno(), section.size))
+                       for key, section in self.SECTIONS)
+        return AcSharedMemory(mode, handles=handles)
+
+    def _pack(self, key, section, name, *values):
+        field = section.memStruct[name]
+        struct.pack_into('<%d%s' % (len(values), field['type']), self.handles[key],
+                         field['offset'], *values)
+
+    def write(self, car):
+        self.packet_id += 1
+        self._pack('physics', AcPhysics, 'gas', car.gas)
+        self._pack('physics', AcPhysics, 'brake', car.brake)
+        self._pack('physics', AcPhysics, 'gear', car.gear)
+        self._pack('physics', AcPhysics, 'speedKmh', car.speed)
+        self._pack('physics', AcPhysics, 'heading', car.heading)
+        self._pack('physics', AcPhysics, 'wheelAngularSpeed', *((car.speed / 3.6 / 0.3,) * 4))
+        self._pack('physics', AcPhysics, 'packetId', self.packet_id)
+
+    def close(self):
+        for key in list(self.handles):
+            self.handles.pop(key).close()
+            self.files.pop(key).close()
+
+
+class Timeline(object):
+    '''
+    The laps of the export one after the other, to find where a car is at
+    a given time since the start
+    '''
+    def __init__(self, laps):
+        self.laps = []      # (start, lap, times, laptime) in ms
+        start = 0.0
+        for lap in laps:
+            if len(lap.points) < 2:
+                continue
+            times = TimingTable(lap).times
+            laptime = lap.laptime or times[-1]
+            self.laps.append((start, lap, times, laptime))
+            start += laptime
+        self.starts = [lap[0] for lap in self.laps]
+        self.duration = start
+
+    def frames(self, fps):
+        '''
+        Yield the time of each frame, each lap starts with a new frame
+        '''
+        step = 1000.0 / fps
+        for start, lap, times, laptime in self.laps:
+            elapsed = 0.0
+            while elapsed < laptime:
+                yield start + elapsed
+                elapsed += step
+
+    def set_state(self, car, elapsed):
+        '''
+        Set the car's state at 'elapsed' ms, the laps are repeated after the
+        last one
+        '''
+        loops, elapsed = divmod(elapsed, self.duration)
+        number = max(bisect.bisect_right(self.starts, elapsed) - 1, 0)
+        start, lap, times, end = self.laps[number]
+        laptime = elapsed - start
+        car.lap_count = number + int(loops) * len(self.laps)
+        car.last_laptime = int(self.laps[number - 1][3]) if car.lap_count else 0
+
+        # The car is between the points i and i + 1, at ratio of the way
+        i = min(max(bisect.bisect_right(times, laptime) - 1, 0), len(times) - 2)
+        duration = times[i + 1] - times[i]
+        ratio = min(max((laptime - times[i]) / duration, 0), 1) if duration else 0
+
+        points = lap.points
+        car.laptime = int(laptime)
+        car.invalid = lap.invalid
+        car.position = (interpolate(points.x, i, ratio), interpolate(points.y, i, ratio),
+                        interpolate(points.z, i, ratio))
+        position = points.position[i]
+        car.track_position = position if position == position else 0.0
+        car.heading = math.atan2(points.x[i + 1] - points.x[i], points.z[i + 1] - points.z[i])
+        car.speed = interpolate(points.speed, i, ratio)
+        car.gas = points.gas[i]
+        car.brake = points.brake[i]
+        car.clutch = points.clutch[i]
+        car.gear = points.gear[i]
+
+
+def interpolate(column, i, ratio):
+    return column[i] + (column[i + 1] - column[i]) * ratio
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) * 1000,
+        'p50': values[len(values) // 2] * 1000,
+        'p99': values[min(len(values) - 1, int(len(values) * 0.99))] * 1000,
+        'max': values[-1] * 1000,
+    }
+
+
+def replay(filename, fps=FPS, realtime=False, max_laps=None, trace_memory=False,
+           frames_file=None, cars=1, clicks=()):
+    '''
+    Replay the export file through racingline.py, returns the report. The
+    durations of each frame are written as CSV to frames_file if given.
+    The other cars (cars - 1) drive the same laps, spread along them. The
+    widget buttons named in clicks (see racingline.UI) are clicked after
+    the last frame, the report lists the exported files
+    '''
+    reader = ExportReader(filename)
+    header = reader.header()
+    if header is None:
+        raise ValueError('Can\'t read file "%s"' % filename)
+
+    cars = [CarState() for n in range(max(cars, 1))]
+    for other in cars:
+        other.trackname = header.get('trackname', 'track')
+        other.carname = header.get('carname', 'car')
+    car = cars[0]
+    ac, acsys = fake_modules(cars)
+    sys.modules.setdefault('ac', ac)
+    sys.modules.setdefault('acsys', acsys)
+    import racingline
+    # In case racingline was already imported with other modules
+    racingline.ac = ac
+    racingline.acsys = acsys
+
+    path = tempfile.mkdtemp()
+    shm = SharedMemoryFiles(path)
+
+    class ReplaySession(Session):
+        '''
+        Session using the shared memory files, the files it writes (best
+        laps, etc.) go to a temporary directory
+        '''
+        def __init__(self, *args):
+            Session.__init__(self, *args)
+            self.app_path = path
+            self.telemetry = Telemetry(factory=shm.factory)
+
+    racingline.Session = ReplaySession
+    laps = list(reader.laps())
+    if max_laps:
+        laps = laps[:max_laps]
+    timeline = Timeline(laps)
+    offsets = [timeline.duration * n / len(cars) for n in range(len(cars))]
+    if trace_memory and tracemalloc:
+        tracemalloc.start()
+
+    update_times = []
+    render_times = []
+    frame_times = []
+    step = 1.0 / fps
+    frames_writer = None
+    if frames_file:
+        frames_writer = csv.writer(frames_file)
+        frames_writer.writerow(('frame', 'lap', 'laptime', 'update_ms', 'render_ms'))
+    try:
+        racingline.acMain('replay')
+        session = racingline.session
+        session.stats.enable()
+        session.stats.interval = float('inf')
+
+        start = time.perf_counter()
+        for elapsed in timeline.frames(fps):
+            for other, offset in zip(cars, offsets):
+                timeline.set_state(other, elapsed + offset)
+            shm.write(car)
+
+            frame_start = time.perf_counter()
+            racingline.acUpdate(step)
+            update_end = time.perf_counter()
+            racingline.onFormRender(step)
+            frame_end = time.perf_counter()
+            update_times.append(update_end - frame_start)
+            render_times.append(frame_end - update_end)
+            frame_times.append(frame_end - frame_start)
+            if frames_writer:
+                frames_writer.writerow((len(frame_times), car.lap_count, car.laptime,
+                                        '%.4f' % ((update_end - frame_start) * 1000),
+                                        '%.4f' % ((frame_end - update_end) * 1000)))
+
+            if realtime:
+                delay = start + len(frame_times) * step - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+        duration = time.perf_counter() - start
+        for name in clicks:
+            ac.listeners[session.ui.buttons[name]](0, 0)
+        session.writer.flush()
+        laps_usage = session.laps.usage()
+        racingline.acShutdown()
+        exports = []
+        if os.path.isdir(os.path.join(path, 'exports')):
+            exports = sorted(os.listdir(os.path.join(path, 'exports')))
+        stages = session.stats.report()
+        car_best_laps = sum(1 for car_id in session.cars.cars if session.cars.best_lap(car_id))
+    finally:
+        racingline.Session = Session
+        shm.close()
+        shutil.rmtree(path)
+
+    # The same error usually happens on every frame
+    errors = {}
+    for msg in ac.logs:
+        if not msg.startswith('RacingLine stats'):
+            errors[msg] = errors.get(msg, 0) + 1
+
+    report = {
+        'file': os.path.basename(filename),
+        'laps': len(laps),
+        'frames': len(frame_times),
+        'fps': fps,
+        'duration': duration,
+        'frame': percentiles(frame_times),
+        'update': percentiles(update_times),
+        'render': percentiles(render_times),
+        'stages': stages,
+        'gl_calls': ac.gl_calls,
+        'cars': len(cars),
+        'car_best_laps': car_best_laps,
+        'laps_memory': laps_usage,
+        'exports': exports,
+        'errors': errors,
+    }
+    if resource:
+        # Kilobytes on Linux
+        report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if trace_memory and tracemalloc:
+        report['peak_python_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay an export file through the app')
+    parser.add_argument('filename', help='export file (JSON or compact)')
+    parser.add_argument('--fps', type=float, default=FPS,
+                        help='frames per second (default: %(default)s)')
+    parser.add_argument('--realtime', action='store_true',
+                        help='replay at 1x instead of as fast as possible')
+    parser.add_argument('--laps', type=int, help='only replay the first laps')
+    parser.add_argument('--cars', type=int, default=1,
+                        help='number of cars, the others drive the same laps (default: %(default)s)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='report the peak Python memory (slower)')
+    parser.add_argument('--click', action='append', default=[], metavar='BUTTON',
+                        help='click this widget button after the last frame (e.g. export_ring)')
+    parser.add_argument('-f', '--frames', help='save the durations of each frame to this CSV file')
+    parser.add_argument('-o', '--output', help='save the report to this file')
+    args = parser.parse_args(argv)
+
+    frames_file = open(args.frames, 'w', newline='') if args.frames else None
+    try:
+        report = replay(args.filename, args.fps, args.realtime, args.laps,
+                        args.trace_memory, frames_file, args.cars, args.click)
+    finally:
+        if frames_file:
+            frames_file.close()
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    sys.stdout.write(data + '\n')
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
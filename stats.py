@@ -0,0 +1,170 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Copyright (C) 2014 - Mathias Andre
+
+'''
+Timing of the app's callbacks and of their stages, to know how much of AC's
+frame time we use. Durations are counted in histograms which are reported
+and reset every few seconds. When disabled a timer only costs two calls.
+
+    start = stats.start()
+    ...
+    stats.stop('stage', start)
+'''
+
+import bisect
+import json
+import time
+
+clock = time.perf_counter
+
+# Upper bounds of the histograms buckets in seconds: 4 per octave from 1us
+# to 1s, longer durations go in the last bucket
+BOUNDS = [1e-6 * 2 ** (i / 4.) for i in range(81)]
+
+# Duration over which a stage goes over its budget, in seconds
+BUDGETS = {
+    'update': 0.001,
+    'render': 0.001,
+}
+
+
+class Histogram(object):
+    '''
+    Count of durations by bucket, see BOUNDS
+    '''
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.overruns = 0   # Number of durations over budget
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if self.budget is not None and duration > self.budget:
+            self.overruns += 1
+
+    def percentile(self, ratio):
+        '''
+        Returns the upper bound of the bucket holding the given percentile
+        '''
+        target = ratio * self.count
+        running = 0
+        for i, count in enumerate(self.counts):
+            running += count
+            if count and running >= target:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        '''
+        Returns the statistics in ms
+        '''
+        return {
+            'count': self.count,
+            'mean': self.total / self.count * 1000 if self.count else 0,
+            'p50': self.percentile(0.5) * 1000,
+            'p99': self.percentile(0.99) * 1000,
+            'max': self.max * 1000,
+            'overruns': self.overruns,
+        }
+
+
+class Stats(object):
+    '''
+    Histograms of the durations of each stage, reported every 'interval'
+    seconds to output (a function such as ac.log) and appended to the file
+    'path' as JSON lines, through 'writer' if given
+    '''
+    def __init__(self, writer=None, interval=30.0, budgets=None):
+        self.enabled = False
+        self.writer = writer
+        self.interval = interval
+        self.budgets = dict(BUDGETS if budgets is None else budgets)
+        self.output = None
+        self.path = None
+        self.histograms = {}
+        self.last_report = None
+
+    def enable(self, enabled=True):
+        '''
+        Turn the timers on or off, the statistics start from scratch
+        '''
+        self.enabled = enabled
+        self.histograms = {}
+        self.last_report = None
+
+    def start(self):
+        '''
+        Returns the start time to give to stop, or None if disabled
+        '''
+        if not self.enabled:
+            return None
+        return clock()
+
+    def stop(self, stage, start):
+        '''
+        Count the duration of the stage since start (see start)
+        '''
+        if start is None:
+            return
+        duration = clock() - start
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram(self.budgets.get(stage))
+        histogram.add(duration)
+
+    def tick(self):
+        '''
+        Called once per frame, reports the statistics every interval
+        '''
+        if not self.enabled:
+            return
+        now = clock()
+        if self.last_report is None:
+            self.last_report = now
+        elif now - self.last_report >= self.interval:
+            self.last_report = now
+            self.dump()
+
+    def report(self):
+        '''
+        Returns the statistics of each stage
+        '''
+        return dict((stage, histogram.summary())
+                    for stage, histogram in list(self.histograms.items()))
+
+    def dump(self):
+        '''
+        Report the statistics and start new histograms
+        '''
+        line = json.dumps({'time': time.time(), 'stages': self.report()}, sort_keys=True)
+        self.histograms = {}
+
+        if self.output:
+            self.output('RacingLine stats: %s' % line)
+        if self.path:
+            if self.writer:
+                self.writer.submit(self._write, line)
+            else:
+                self._write(line)
+
+    def _write(self, line):
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
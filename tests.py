@@ -1,8 +1,41 @@
 import json
 import math
+import mmap
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
 import unittest
 
-from models import Point, Lap, Session, get_color_from_ratio
+from acpmf import AcSharedMemory, AcPhysics, AcGraphics, AcStatic, AC_PHYSICS, AC_GRAPHICS
+import analyse
+import bench
+import codec
+import replay
+import stats
+from models import NAN, Cars, LapStore, Point, PointArray, Lap, RingBuffer, Sampler, Session, Telemetry, ExportReader, get_color_from_ratio, \
+    simplify_indexes, GREEN, GREY_30, RED
+
+
+def fake_shm_factory(buffers, graphics=None):
+    '''
+    Returns a shared memory factory using anonymous maps instead of AC's,
+    the created physics buffers are appended to 'buffers' and the graphics
+    ones to 'graphics' if given
+    '''
+    def factory(mode):
+        handles = {
+            'physics': mmap.mmap(-1, AcPhysics.size),
+            'graphics': mmap.mmap(-1, AcGraphics.size),
+        }
+        buffers.append(handles['physics'])
+        if graphics is not None:
+            graphics.append(handles['graphics'])
+        return AcSharedMemory(mode, handles=handles)
+    return factory
 
 
 class TestPoint(unittest.TestCase):
@@ -27,6 +60,46 @@ class TestPoint(unittest.TestCase):
         self.assertEqual(result['c'], self.point.clutch)
 
 
+class TestPointArray(unittest.TestCase):
+    def setUp(self):
+        self.points = PointArray()
+        self.points.append(Point(10.12, -100, 33, 154.31, 0.5, 0, 0, 3, 0.25))
+        self.points.append(Point(11, -100, 34, 155, 1, 0, 0, 4))
+
+    def test_view(self):
+        point = self.points[0]
+        self.assertEqual((point.x, point.speed, point.gear), (10.12, 154.31, 3))
+        self.assertEqual(point.position, 0.25)
+        self.assertEqual(self.points[-1].position, None)
+        self.assertEqual(point.best_speed, None)
+        point.best_speed = 140.5
+        self.assertEqual(self.points[0].best_speed, 140.5)
+        self.assertRaises(IndexError, lambda: self.points[2])
+
+    def test_slice(self):
+        points = self.points[1:]
+        self.assertEqual(len(points), 1)
+        self.assertTrue(points[0].equal_coords(self.points[1]))
+        self.assertEqual(points[0].dumps(), self.points[1].dumps())
+
+    def test_dumps(self):
+        self.assertEqual(self.points.dumps(), [
+            {'x': 10.12, 'y': -100, 'z': 33, 's': 154.31, 'g': 0.5, 'b': 0, 'c': 0, 'r': 3,
+             'n': 0.25, 't': None},
+            {'x': 11, 'z': 34, 's': 155, 'g': 1, 'r': 4, 'n': None},
+        ])
+        # The points before first are only used as reference
+        self.assertEqual(self.points.dumps(1), self.points.dumps()[1:])
+
+    def test_loads(self):
+        previous = {}
+        points = PointArray.loads(self.points.dumps()[:1], previous)
+        points.extend(PointArray.loads(self.points.dumps(1), previous))
+        self.assertEqual([p.dumps() for p in points], [p.dumps() for p in self.points])
+        self.assertEqual(previous['r'], 4)
+        self.assertEqual(len(PointArray.loads([])), 0)
+
+
 class TestLap(unittest.TestCase):
     def setUp(self):
         session = Session()
@@ -64,6 +137,88 @@ class TestLap(unittest.TestCase):
         self.assertTrue(result[2].equal_coords(Point(201, 0, 99)))
         self.assertTrue(result[3].equal_coords(Point(200, 0, 100)))
 
+    def test_transform(self):
+        self.lap.points.append(Point(500, 0, 15))
+        self.lap.points.append(Point(18, 0, 15))
+        self.lap.points.append(Point(19, 0, 16))
+        xs, zs, segments = self.lap.transform(self.lap.points[3], 0)
+        self.assertEqual(segments, [(0, 4), (5, 7)])
+        self.assertEqual((round(xs[3], 2), round(zs[3], 2)), (200, 100))
+
+        result = self.lap.normalise(self.lap.points[3], 0)
+        self.assertEqual(len(result), 6)
+        self.assertTrue(result[3].end)
+        self.assertTrue(result[4].start)
+
+    def test_render_cache(self):
+        reference = self.lap.points[3]
+        xs, zs, segments = self.lap.transform(reference, 1)
+        # Sub-pixel change, the same result is used
+        self.assertTrue(self.lap.transform(reference, 1.0001)[0] is xs)
+        self.assertFalse(self.lap.transform(reference, 1.1)[0] is xs)
+        self.lap.session.zoom = 2
+        self.assertFalse(self.lap.transform(reference, 1.1)[0] is xs)
+
+        # New points extend the cached result
+        xs, zs, segments = self.lap.transform(reference, 1.1)
+        self.lap.points.append(Point(500, 0, 15))
+        self.lap.points.append(Point(18, 0, 15))
+        self.assertTrue(self.lap.transform(reference, 1.1)[0] is xs)
+        self.lap.render_cache = None
+        self.assertEqual(self.lap.transform(reference, 1.1), (xs, zs, segments))
+
+    def test_render(self):
+        calls = []
+
+        class GLAc(object):
+            def glBegin(self, mode):
+                calls.append('begin')
+
+            def glEnd(self):
+                calls.append('end')
+
+            def glVertex2f(self, x, y):
+                calls.append('vertex')
+
+            def glColor4f(self, r, g, b, a):
+                calls.append((r, g, b, a))
+
+        self.lap.session.ac = GLAc()
+        self.lap.session.acsys = bench.FakeAcsys
+        # Two points slower than the best lap, one similar and one without best speed
+        for i, best_speed in enumerate((105, 120, 131, None)):
+            self.lap.points[i].best_speed = best_speed
+        self.lap.render(self.lap.last_point, 0)
+        self.assertEqual(calls, ['begin', RED, 'vertex', 'vertex', GREEN, 'vertex', 'vertex', 'end'])
+
+        # The new point is added to the last run
+        self.lap.points.append(Point(18, 0, 16, 140))
+        del calls[:]
+        self.lap.render(self.lap.last_point, 0)
+        self.assertEqual(calls.count('vertex'), 5)
+        self.assertEqual(len(self.lap.color_runs.starts), 2)
+
+        del calls[:]
+        self.lap.render(self.lap.last_point, 0, GREY_30)
+        self.assertEqual(calls, [GREY_30, 'begin'] + ['vertex'] * 5 + ['end'])
+
+    def test_simplify(self):
+        lap = Lap(self.lap.session, 0)
+        for i in range(100):
+            angle = 2 * math.pi * i / 100
+            lap.points.append(Point(100 * math.cos(angle), 0, 100 * math.sin(angle),
+                                    100 + i))
+        lap.simplify()
+        lap.session.zoom = 4
+        self.assertTrue(lap.render_points() is lap.points)
+        lap.session.zoom = 0.2
+        points = lap.render_points()
+        self.assertTrue(2 < len(points) < len(lap.points))
+        self.assertEqual(points.speed[-1], lap.points.speed[-1])
+        # Zoom out a lot, the most simplified version is used
+        lap.session.zoom = 0.01
+        self.assertTrue(lap.render_points() is lap.levels[-1][1])
+
     def test_json_dumps(self):
         session = Session()
         lap = Lap(session, 0)
@@ -75,10 +230,102 @@ class TestLap(unittest.TestCase):
             for key, dummy in p2.keys:
                 self.assertEqual(getattr(p1, key), getattr(p2, key))
 
+    def test_binary_dumps(self):
+        self.lap.count = 3
+        self.lap.laptime = 61234
+        self.lap.points[1].position = 0.5
+        self.lap.points[1].time = 125
+        lap = Lap(Session(), 0)
+        lap.binary_loads(self.lap.binary_dumps())
+        self.assertEqual((lap.count, lap.laptime, lap.invalid), (3, 61234, 0))
+        self.assertEqual(len(lap.points), len(self.lap.points))
+        self.assertEqual(len(lap.points.best_speed), len(self.lap.points))
+        for p1, p2 in zip(lap.points, self.lap.points):
+            self.assertEqual(p1.dumps(), p2.dumps())
+        self.assertRaises(ValueError, lap.binary_loads, b'{"points": []}')
+        self.assertRaises(ValueError, lap.binary_loads, self.lap.binary_dumps()[:-1])
+
+        # Version 1 files don't have the time
+        data = bytearray(self.lap.binary_dumps()[:-4 * len(self.lap.points)])
+        data[4:6] = struct.pack('<H', 1)
+        lap = Lap(Session(), 0)
+        lap.binary_loads(bytes(data))
+        self.assertEqual(lap.points[1].position, 0.5)
+        self.assertEqual(lap.points[1].time, None)
+
+    def test_timing(self):
+        lap = Lap(Session(), 0)
+        lap.laptime = 3000
+        lap.points.append(Point(0, 0, 0, 36, t=0))
+        lap.points.append(Point(10, 0, 0, 36, t=1000))
+        lap.points.append(Point(20, 0, 0, 72, t=1500))
+        lap.points.append(Point(20, 0, 20, 72, t=2500))
+        lap.build_index()
+        self.assertEqual(lap.timing.time_at(15), 1250)
+        self.assertEqual(lap.timing.distance_at(Point(15, 0, 2), 1), 15)
+        self.assertEqual(lap.timing.delta(Point(15, 0, 2), 1, 1350), 100)
+        self.assertEqual(lap.timing.delta(Point(20, 0, 15), 3, 2000), -250)
+
+        # Without recorded times they are estimated from the speed
+        for point in lap.points:
+            point.time = None
+        lap.build_index()
+        self.assertEqual([round(t) for t in lap.timing.times], [0, 1125, 1875, 3000])
+
     def test_closest_point(self):
         point = Point(14, 0, 13)
         self.assertEqual(self.lap.closest_point(point), self.lap.points[2])
 
+    def test_closest_point_index(self):
+        rand = random.Random(0)
+        lap = Lap(self.lap.session, 0)
+        for i in range(500):
+            lap.points.append(Point(rand.uniform(-500, 500), rand.uniform(-5, 5),
+                                    rand.uniform(-300, 300)))
+        # Duplicate, the first one should be returned
+        lap.points.append(Point(lap.points[10].x, lap.points[10].y, lap.points[10].z))
+        expected = [lap.closest_point(lap.points[10])]
+        queries = [Point(rand.uniform(-800, 800), rand.uniform(-5, 5),
+                         rand.uniform(-600, 600)) for i in range(200)]
+        expected += [lap.closest_point(point) for point in queries]
+
+        lap.build_index()
+        self.assertFalse(lap.position_index)
+        result = [lap.closest_point(lap.points[10])]
+        result += [lap.closest_point(point) for point in queries]
+        self.assertEqual(result, expected)
+        self.assertEqual(result[0].i, 10)
+
+    def test_comparable_point(self):
+        # Figure-eight: the last two points cross the start of the lap
+        lap = Lap(self.lap.session, 0)
+        lap.points.append(Point(0, 0, 0, n=0.01))
+        lap.points.append(Point(50, 0, 50, n=0.25))
+        lap.points.append(Point(100, 0, 0, n=0.5))
+        lap.points.append(Point(50, 0, -50, n=0.75))
+        lap.points.append(Point(1, 0, 1, n=0.98))
+        lap.build_index()
+        self.assertEqual(lap.comparable_point(Point(0, 0, 0, n=0.52)), lap.points[2])
+        self.assertEqual(lap.comparable_point(Point(0, 0, 0, n=0.999)), lap.points[0])
+        self.assertEqual(lap.comparable_point(Point(0, 0, 0, n=0.9)), lap.points[4])
+        # Without track position we fall back to the closest point
+        self.assertEqual(lap.comparable_point(Point(90, 0, 0)), lap.points[2])
+
+    def test_matcher(self):
+        # Circle of 200 points with a radius of 300m
+        lap = Lap(self.lap.session, 0)
+        for i in range(200):
+            angle = 2 * math.pi * i / 200
+            lap.points.append(Point(300 * math.cos(angle), 0, 300 * math.sin(angle)))
+        lap.build_index()
+
+        current = Lap(self.lap.session, 1)
+        for i in list(range(190, 200)) + list(range(0, 30)) + list(range(120, 130)):
+            angle = 2 * math.pi * (i + 0.3) / 200
+            point = Point(302 * math.cos(angle), 0, 302 * math.sin(angle))
+            self.assertEqual(current.compare(point, lap), lap.closest_point(point))
+            self.assertEqual(current.matcher.last, i)
+
 
 class TestSession(unittest.TestCase):
     def setUp(self):
@@ -107,8 +354,667 @@ class TestSession(unittest.TestCase):
         # Check best_lap has been updated
         self.assertEqual(self.session.best_lap.laptime, 5500)
 
+    def test_render_reference(self):
+        session = bench.render_session()
+        session.current_data['heading'] = 0
+        session.new_lap(0)
+        session.current_lap.points.append(Point(10, 0, 10, 100))
+        session.render()
+        self.assertEqual(session.current_lap.render_cache.transform.reference, (10, 10))
+
+        # The car moved on since the last point was recorded
+        session.ring.append(25, 0, 10, 100, 1, 0, 0, 3, NAN, 500)
+        session.render()
+        self.assertEqual(session.current_lap.render_cache.transform.reference, (25, 10))
+
+    def test_new_lap_sampler(self):
+        self.session.sampler.sample(0.1, (0, 0, 0), 0, 0, 0, 1)
+        self.session.new_lap(0)
+        self.assertTrue(self.session.sampler.sample(0.1, (0, 0, 0), 0, 0, 0, 1))
+
+
+class TestCars(unittest.TestCase):
+    def test_schedule(self):
+        cars = Cars(Session(), per_tick=3)
+        self.assertEqual(cars.schedule(5), [1, 2, 3])
+        self.assertEqual(cars.schedule(5), [4, 1, 2])
+        self.assertEqual(cars.schedule(2), [1])
+        self.assertEqual(cars.schedule(1), [])
+
+    def test_update(self):
+        states = [replay.CarState() for i in range(3)]
+        ac, acsys = replay.fake_modules(states)
+        session = Session(ac, acsys)
+        session.cars.enabled = True
+        session.cars.per_tick = 1
+        lap = bench.synthetic_lap(session, 200)
+        timeline = replay.Timeline([lap] * 3)
+
+        # The first lap seen of each car isn't recorded, we can't know if we
+        # have it from the start
+        for elapsed in timeline.frames(30):
+            timeline.set_state(states[1], elapsed)
+            timeline.set_state(states[2], elapsed + lap.laptime / 2)
+            session.cars.update(1 / 30.)
+
+        self.assertEqual(len(session.cars), 2)
+        for car_id in (1, 2):
+            best_lap = session.cars.best_lap(car_id)
+            self.assertEqual(best_lap.laptime, lap.laptime)
+            self.assertTrue(len(best_lap.points) > 20)
+        self.assertEqual(session.cars[1].best_lap.count, 1)
+        self.assertEqual(session.cars[2].best_lap.count, 1)
+
+        self.assertEqual(session.next_overlay(), 'Driver 1')
+        self.assertEqual(session.next_overlay(), 'Driver 2')
+        self.assertEqual(session.next_overlay(), '')
+        self.assertEqual(session.overlay_car, None)
+
+
+class TestLapStore(unittest.TestCase):
+    def test_lap_store(self):
+        session = Session()
+        laps = session.laps
+        laps.recent = 2
+        laps.budget = 30000
+        for count in range(6):
+            session.current_lap = bench.synthetic_lap(session, 200, seed=count, count=count)
+            if count == 0:
+                session.best_lap = session.current_lap
+            laps.append(session.current_lap)
+        session.writer.flush()
+
+        # Each lap uses 8200 bytes, only the best lap and the 2 recent ones fit
+        self.assertEqual(session.current_lap.nbytes(), 8200)
+        self.assertEqual(laps.laps[1:4], [None, None, None])
+        self.assertEqual(laps.usage(), {'laps': 6, 'resident': 3, 'resident_bytes': 24600,
+                                        'file_bytes': laps.usage()['file_bytes']})
+        self.assertTrue(laps.usage()['file_bytes'] > 0)
+
+        # Laps are read back when used and others go out of memory
+        expected = bench.synthetic_lap(session, 200, seed=2, count=2)
+        # The file has the precision of the compact exports
+        lap = laps[2]
+        self.assertEqual(len(lap.points), 200)
+        self.assertTrue(max(abs(a - b) for a, b in zip(lap.points.x, expected.points.x)) < 0.01)
+        self.assertEqual(list(lap.points.time), [round(t) for t in expected.points.time])
+        self.assertEqual(laps[2].laptime, expected.laptime)
+        # The lap used last stays in memory even if over budget
+        self.assertEqual(laps.resident_bytes, 32800)
+        self.assertEqual([lap.count for lap in laps], list(range(6)))
+        self.assertEqual(list(laps.used), [0, 4, 5])
+        self.assertTrue(laps.laps[0] is session.best_lap)
+
+        laps.close()
+
+    def test_full_writer(self):
+        # The writer's queue fills up while it waits for the lap store
+        session = Session()
+        session.laps.recent = 1
+        session.laps.budget = 1000
+
+        laps = [bench.synthetic_lap(session, 500, seed=count, count=count) for count in range(60)]
+
+        def append():
+            for lap in laps:
+                session.laps.append(lap)
+            session.writer.flush()
+
+        thread = threading.Thread(target=append)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([lap.count for lap in session.laps], list(range(60)))
+        session.shutdown()
+
+    def test_pending_write(self):
+        class Writer(object):
+            def __init__(self):
+                self.jobs = []
+
+            def submit(self, function, *args):
+                self.jobs.append((function, args))
+
+        session = Session()
+        writer = Writer()
+        jobs = writer.jobs
+        laps = LapStore(session, recent=1, budget=10000, writer=writer)
+        for count in range(3):
+            laps.append(bench.synthetic_lap(session, 200, seed=count, count=count))
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(laps.offsets, [LapStore.WRITING, LapStore.WRITING, None])
+
+        # Lap 0 is used and goes out again before the writer runs: only one write
+        laps[0]
+        laps[2]
+        self.assertEqual(list(laps.used), [2])
+        self.assertEqual(len(jobs), 2)
+
+        # Lap 1 is used again while being written so it stays in memory
+        laps[1]
+        for function, args in jobs:
+            function(*args)
+        self.assertTrue(laps.laps[0] is None)
+        self.assertTrue(laps.laps[1] is not None)
+        self.assertTrue(min(laps.offsets[:2]) >= 0)
+        self.assertEqual([lap.count for lap in laps], [0, 1, 2])
+
+        laps.close()
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_ring_buffer(self):
+        ring = RingBuffer(4)
+        for i in range(6):
+            ring.append(i, 0, -i, 100 + i, 1, 0, 0, 3, NAN if i < 5 else 0.5, i * 10)
+        self.assertEqual(len(ring), 4)
+        self.assertEqual(ring.record(0)[0], 2)
+        self.assertEqual(ring.point(-1).dumps(), Point(5, 0, -5, 105, 1, 0, 0, 3, 0.5, 50).dumps())
+        self.assertRaises(IndexError, ring.record, 4)
+        points = ring.points()
+        self.assertEqual(list(points.x), [2, 3, 4, 5])
+        self.assertEqual(points[0].position, None)
+
+    def test_export_ring(self):
+        session = Session()
+        session.app_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, session.app_path)
+        session.console = lambda msg: None
+        for i in range(3):
+            session.ring.append(i, 0, i, 100, 1, 0, 0, 3, NAN, i * 10)
+        session.export_ring()
+        session.shutdown()
+
+        path = os.path.join(session.app_path, 'exports')
+        imported = Session()
+        imported.import_data(os.path.join(path, os.listdir(path)[0]))
+        self.assertEqual(list(imported.laps[0].points.time), [0, 10, 20])
+
+
+class TestSampler(unittest.TestCase):
+    def test_sample(self):
+        sampler = Sampler(tolerance=0.05, distance=30, inputs=0.2, max_gap=1)
+        self.assertTrue(sampler.sample(0.1, (0, 0, 0), 0, 1, 0, 3))
+        # Stationary
+        self.assertFalse(sampler.sample(5, (0.1, 0, 0), 0, 0, 1, 2))
+        sampler.elapsed = 0
+        # Straight line
+        self.assertFalse(sampler.sample(0.1, (0, 0, 20), 0, 1, 0, 3))
+        self.assertTrue(sampler.sample(0.1, (0, 0, 31), 0, 1, 0, 3))
+        # Turning
+        self.assertFalse(sampler.sample(0.1, (0, 0, 35), 0.05, 1, 0, 3))
+        self.assertTrue(sampler.sample(0.1, (0, 0, 35), 0.11, 1, 0, 3))
+        # Inputs
+        self.assertFalse(sampler.sample(0.1, (0, 0, 36), 0.11, 0.9, 0, 3))
+        self.assertTrue(sampler.sample(0.1, (0, 0, 37), 0.11, 1, 0.5, 3))
+        self.assertTrue(sampler.sample(0.1, (0, 0, 38), 0.11, 1, 0.5, 4))
+        # Time
+        self.assertTrue(sampler.sample(1, (0, 0, 39), 0.11, 1, 0.5, 4))
+
+
+class TestAcSharedMemory(unittest.TestCase):
+    def setUp(self):
+        self.handles = {
+            'physics': mmap.mmap(-1, AcPhysics.size),
+            'graphics': mmap.mmap(-1, AcGraphics.size),
+            'static': mmap.mmap(-1, AcStatic.size),
+        }
+        self.shm = AcSharedMemory(7, handles=self.handles)
+
+    def test_layout(self):
+        for section in (AcPhysics, AcGraphics, AcStatic):
+            self.assertEqual(section.struct.size, section.size)
+
+    def test_read_section(self):
+        struct.pack_into('<L', self.handles['physics'], 0, 42)
+        struct.pack_into('<f', self.handles['physics'], 208, 1.5)
+        struct.pack_into('<4f', self.handles['physics'], 104, 1, 2, 3, 4)
+        struct.pack_into('<10s', self.handles['graphics'], 12, b'1:23:456')
+        physics = self.shm.readSection('physics')
+        self.assertEqual(physics.packetId, 42)
+        self.assertEqual(physics.heading, 1.5)
+        self.assertEqual(physics.wheelAngularSpeed, (1, 2, 3, 4))
+        self.assertEqual(self.shm.readAll()['graphics'].currentTime, '1:23:456')
+
+    def test_read_value(self):
+        struct.pack_into('<f', self.handles['physics'], 208, 1.5)
+        self.shm.readValue('physics', 'heading')
+        self.assertEqual(self.shm.shm['physics'].memStruct['heading']['val'],
+                         self.shm.readSection('physics').heading)
+
+    def test_snapshot(self):
+        struct.pack_into('<L', self.handles['physics'], 0, 1)
+        self.assertEqual(self.shm.snapshot('physics').packetId, 1)
+        # Same packetId, nothing changed
+        self.assertEqual(self.shm.snapshot('physics'), None)
+        struct.pack_into('<L', self.handles['physics'], 0, 2)
+        self.assertEqual(self.shm.snapshot('physics').packetId, 2)
+        # static doesn't have a packetId
+        self.assertNotEqual(self.shm.snapshot('static'), None)
+
+    def test_snapshot_torn(self):
+        class TornBuffer(bytearray):
+            '''
+            Simulate AC writing a new packet while we copy the first one
+            '''
+            copies = 0
+
+            def __getitem__(self, key):
+                data = bytearray.__getitem__(self, key)
+                self.copies += 1
+                if self.copies == 1:
+                    struct.pack_into('<Lf', self, 0, 2, 1.5)
+                return data
+
+            def close(self):
+                pass
+
+        handle = TornBuffer(AcPhysics.size)
+        struct.pack_into('<L', handle, 0, 1)
+        shm = AcSharedMemory(1, handles={'physics': handle})
+        physics = shm.snapshot('physics')
+        self.assertEqual(handle.copies, 2)
+        self.assertEqual((physics.packetId, physics.gas), (2, 1.5))
+
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        self.buffers = []
+        self.telemetry = Telemetry(factory=fake_shm_factory(self.buffers))
+
+    def set_heading(self, value):
+        offset = AcPhysics.memStruct['heading']['offset']
+        struct.pack_into('<f', self.buffers[-1], offset, value)
+
+    def test_open_once(self):
+        self.telemetry.open()
+        self.set_heading(1.5)
+        self.assertEqual(self.telemetry.read_value('physics', 'heading'), 1.5)
+        self.set_heading(0.5)
+        self.assertEqual(self.telemetry.read_value('physics', 'heading'), 0.5)
+        self.assertEqual(len(self.buffers), 1)
+
+    def test_reopen_when_closed(self):
+        self.telemetry.open()
+        self.buffers[-1].close()
+        self.telemetry.read_value('physics', 'heading')
+        self.assertEqual(len(self.buffers), 2)
+
+    def test_update(self):
+        self.telemetry.open()
+        struct.pack_into('<L', self.buffers[-1], 0, 1)
+        self.assertTrue(self.telemetry.update())
+        self.assertFalse(self.telemetry.update())
+        struct.pack_into('<L', self.buffers[-1], 0, 2)
+        self.assertTrue(self.telemetry.update())
+        self.assertEqual(self.telemetry.physics.packetId, 2)
+
+    def test_update_graphics(self):
+        graphics = []
+        telemetry = Telemetry(AC_PHYSICS | AC_GRAPHICS, fake_shm_factory(self.buffers, graphics))
+        telemetry.open()
+        struct.pack_into('<L', self.buffers[-1], 0, 1)
+        struct.pack_into('<L', graphics[-1], 0, 1)
+        struct.pack_into('<f', graphics[-1], 132, 0.5)
+        telemetry.update()
+        self.assertEqual(telemetry.graphics.normalizedCarPosition, 0.5)
+        # Graphics didn't change, the previous snapshot is kept
+        struct.pack_into('<L', self.buffers[-1], 0, 2)
+        telemetry.update()
+        self.assertEqual(telemetry.graphics.normalizedCarPosition, 0.5)
+
+    def test_close(self):
+        self.telemetry.open()
+        self.telemetry.close()
+        self.assertTrue(self.buffers[-1].closed)
+        self.assertEqual(self.telemetry.shm, None)
+
+
+class TestBestLapFile(unittest.TestCase):
+    def setUp(self):
+        self.session = Session()
+        self.session.app_path = tempfile.mkdtemp()
+        self.session.trackname = 'monza'
+        self.session.carname = 'ferrari_458'
+        self.session.console = lambda msg: None
+        self.lap = Lap(self.session, 0)
+        self.lap.laptime = 105000
+        self.lap.points.append(Point(10, 0, 10, 100, 0.9, 0, 0.2, 3))
+        self.lap.points.append(Point(13, 0, 10, 110, 1.0, 0, 0.0, 4))
+
+    def tearDown(self):
+        shutil.rmtree(self.session.app_path)
+
+    def test_new_best_lap(self):
+        self.session.current_lap = self.lap
+        self.session.new_best_lap()
+        self.session.writer.flush()
+        self.session.best_lap = None
+        self.session.load_best_lap()
+        self.assertEqual(self.session.best_lap.laptime, 105000)
+        self.assertEqual(self.session.best_lap.points[1].dumps(), self.lap.points[1].dumps())
+
+        # The indexes are built by the writer thread
+        self.session.writer.flush()
+        best_lap = self.session.best_lap
+        self.assertEqual(best_lap.index.size, 2)
+        self.assertEqual(best_lap.levels_size, 2)
+        self.assertEqual(len(best_lap.timing.times), 2)
+
+    def test_prepare(self):
+        lap = bench.synthetic_lap(self.session, 500)
+        lap.prepare()
+        indexed = bench.synthetic_lap(self.session, 500)
+        indexed.build_index()
+        indexed.simplify()
+        self.assertEqual(lap.levels_size, 500)
+        self.assertEqual([len(points) for tolerance, points in lap.levels],
+                         [len(points) for tolerance, points in indexed.levels])
+        self.assertEqual(lap.timing.times, indexed.timing.times)
+        for point in lap.points[::50]:
+            self.assertEqual(lap.closest_index(point), indexed.closest_index(point))
+
+    def test_load_json(self):
+        # Best laps from older versions are converted
+        with open(self.session._best_lap_path('json'), 'w') as f:
+            f.write(self.lap.json_dumps() + '\n')
+        self.session.load_best_lap()
+        self.assertTrue(os.path.exists(self.session._best_lap_path()))
+        self.assertEqual(len(self.session.best_lap.points), 2)
+        self.assertEqual(self.session.best_lap.points[0].gear, 3)
+
+    def test_export_data(self):
+        self.session.current_lap = self.lap
+        self.session.export_data()
+        # Later changes to the lap aren't exported
+        self.lap.laptime = 0
+        self.session.shutdown()
+        session = Session()
+        session.import_data(os.path.join(self.session.app_path, 'exports', os.listdir(
+            os.path.join(self.session.app_path, 'exports'))[0]))
+        self.assertEqual(session.laps[0].laptime, 105000)
+        self.assertEqual(session.trackname, 'monza')
+
+    def test_stream_export(self):
+        self.stream_export('json')
+
+    def test_stream_export_compact(self):
+        self.stream_export('compact')
+
+    def stream_export(self, export_format):
+        self.session.export_format = export_format
+        self.session.save_data = True
+        self.session.stream_export = True
+        self.session.export_chunk_size = 3
+
+        def drive(count, points):
+            lap = self.session.current_lap = Lap(self.session, count)
+            for i in range(points):
+                lap.points.append(Point(i, 0, i * 2, 100 + i, 1, 0, 0, 3))
+                lap.laptime = i * 1000
+                self.session.stream_points()
+            return lap
+
+        lap = drive(0, 10)
+        self.session.new_lap(1)
+        drive(1, 5)
+        self.session.new_lap(2, drop=True)
+        unfinished = drive(2, 7)
+        self.session.shutdown()
+
+        session = Session()
+        session.console = lambda msg: None
+        path = os.path.join(self.session.app_path, 'exports')
+        filename = os.path.join(path, os.listdir(path)[0])
+        session.import_data(filename)
+        self.assertEqual(len(session.laps), 2)
+        self.assertEqual(session.laps[0].laptime, 9000)
+        self.assertEqual(session.laps[0].points.dumps(), lap.points.dumps())
+        self.assertTrue(session.laps[1].invalid)
+        self.assertEqual(session.laps[1].points.dumps(), unfinished.points[:6].dumps())
+
+        # Laps can be listed and read on their own using the index
+        reader = ExportReader(filename, session)
+        self.assertEqual([(entry['count'], entry['laptime'], entry['invalid'], entry['points'])
+                          for entry in reader.index()], [(0, 9000, 0, 10), (None, 0, 1, 6)])
+        self.assertTrue(os.path.exists(reader.index_path))
+        reader = ExportReader(filename, session)
+        reader._laps = None     # The index file is used
+        self.assertEqual(len(reader.index()), 2)
+        reader = ExportReader(filename, session)
+        self.assertEqual(reader.get_lap(1).points.dumps(), unfinished.points[:6].dumps())
+        self.assertEqual(reader.get_lap(0).points.dumps(), lap.points.dumps())
+
+    def test_stream_export_toggle(self):
+        for export_format in ('json', 'compact'):
+            self.stream_export_toggle(export_format)
+
+    def stream_export_toggle(self, export_format):
+        # Export is turned off after part of lap 0 was streamed, the chunks
+        # mustn't end up in lap 1
+        session = Session()
+        session.app_path = os.path.join(self.session.app_path, export_format)
+        os.mkdir(session.app_path)
+        session.console = lambda msg: None
+        session.export_format = export_format
+        session.save_data = True
+        session.stream_export = True
+        session.export_chunk_size = 3
+
+        lap = session.current_lap = Lap(session, 0)
+        for i in range(6):
+            lap.points.append(Point(i, 0, i, 100, 1, 0, 0, 3))
+            session.stream_points()
+        session.save_data = False
+        session.new_lap(1)
+        session.save_data = True
+        lap = session.current_lap
+        for i in range(4):
+            lap.points.append(Point(1000 + i, 0, i, 100, 1, 0, 0, 3))
+            session.stream_points()
+        lap.laptime = 5000
+        session.new_lap(2)
+        session.shutdown()
+
+        imported = Session()
+        imported.console = lambda msg: None
+        path = os.path.join(session.app_path, 'exports')
+        imported.import_data(os.path.join(path, os.listdir(path)[0]))
+        self.assertEqual(len(imported.laps), 1)
+        self.assertEqual(list(imported.laps[0].points.x), [1000, 1001, 1002, 1003])
+
+    def test_writer_error(self):
+        messages = []
+        self.session.console = messages.append
+
+        def fail():
+            raise IOError('disk full')
+        self.session.writer.submit(fail)
+        self.session.writer.flush()
+        self.assertEqual(messages, ['Error writing file: disk full'])
+
+
+class TestAnalyse(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def export(self, name, laps):
+        session = Session()
+        session.app_path = self.path
+        session.trackname = 'monza'
+        session.carname = 'ferrari_458'
+        session.start_time = session.start_time.replace(second=name)
+        for count, (laptime, invalid, speed) in enumerate(laps):
+            lap = Lap(session, count)
+            lap.laptime = laptime
+            lap.invalid = invalid
+            for i in range(11):
+                lap.points.append(Point(i * 10, 0, 0, speed + (i == 5) * 50))
+            session._write_export(lap)
+        session.export_file.close()
+
+    def test_analyse(self):
+        self.export(1, [(10000, 0, 100), (9000, 1, 110)])
+        self.export(2, [(11000, 0, 90)])
+        files = analyse.list_exports(os.path.join(self.path, 'exports'))
+        summaries = analyse.analyse(files, jobs=2, sectors=2)
+
+        self.assertEqual(len(summaries), 1)
+        summary = summaries[0]
+        self.assertEqual((summary['laps'], summary['valid_laps']), (3, 2))
+        self.assertEqual(summary['best_lap']['laptime'], 10000)
+        self.assertEqual(summary['laptimes']['median'], 10500)
+        self.assertEqual(summary['top_speed'], 160)
+        # Both laps have the same line and speed profile
+        self.assertEqual(summary['theoretical_best'], 10000)
+
+    def test_sector_times(self):
+        lap = Lap(None, 0)
+        lap.laptime = 3000
+        lap.points.append(Point(0, 0, 0, 36))
+        lap.points.append(Point(10, 0, 0, 36))
+        lap.points.append(Point(20, 0, 0, 72))
+        times = analyse.sector_times(lap, 2)
+        # 1 s at 36 km/h then 2/3 s at 54 km/h on average
+        self.assertAlmostEqual(times[0], 1800)
+        self.assertAlmostEqual(sum(times), 3000)
+
+
+class TestStats(unittest.TestCase):
+    def test_histogram(self):
+        histogram = stats.Histogram(budget=0.005)
+        for i in range(1, 101):
+            histogram.add(i / 10000.)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['overruns'], 50)
+        self.assertEqual(summary['max'], 10)
+        # The percentiles are the upper bound of their bucket, within 19%
+        self.assertTrue(5 <= summary['p50'] < 5 * 1.19)
+        self.assertTrue(9.9 <= summary['p99'] <= 10)
+
+    def test_stats(self):
+        timings = stats.Stats()
+        self.assertEqual(timings.start(), None)
+        timings.stop('update', None)
+        self.assertEqual(timings.report(), {})
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        timings.path = os.path.join(path, 'stats.txt')
+        output = []
+        timings.output = output.append
+        timings.enable()
+        timings.stop('update', timings.start())
+        timings.stop('update', timings.start())
+        timings.dump()
+        self.assertEqual(timings.histograms, {})
+        with open(timings.path) as f:
+            report = json.loads(f.read())
+        self.assertEqual(report['stages']['update']['count'], 2)
+        self.assertEqual(len(output), 1)
+
+
+class TestBench(unittest.TestCase):
+    def test_synthetic_lap(self):
+        lap = bench.synthetic_lap(Session(), 2000, seed=3)
+        self.assertEqual(len(lap.points), 2000)
+        self.assertEqual(lap.points.dumps(), bench.synthetic_lap(Session(), 2000, seed=3).points.dumps())
+        self.assertTrue(60000 < lap.laptime < 180000)
+        self.assertTrue(max(lap.points.speed) > 2 * min(lap.points.speed))
+
+    def test_compare(self):
+        baseline = {'results': {'a': {'min': 1.0}, 'b': {'min': 1.0}}}
+        results = {'results': {'a': {'min': 1.1}, 'b': {'min': 1.5}, 'c': {'min': 1.0}}}
+        sys.stdout, stdout = open(os.devnull, 'w'), sys.stdout
+        try:
+            self.assertEqual(bench.compare(results, baseline, 0.2), [('b', 1.5)])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_replay(self):
+        # The second lap is compared with the first one
+        filename = bench.synthetic_session(self.path, 2, 500)
+        laptimes = [lap.laptime for lap in ExportReader(filename).laps()]
+        report = replay.replay(filename, fps=20)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(report['frames'], sum(int(math.ceil(laptime / 50.)) for laptime in laptimes))
+        self.assertEqual(report['update']['count'], report['frames'])
+        self.assertIn('read', report['stages'])
+        self.assertTrue(report['gl_calls'] > 0)
+
+        # The points have the track position given by ac
+        import racingline
+        best_lap = racingline.session.best_lap
+        positions = list(best_lap.points.position)
+        self.assertEqual(positions, sorted(positions))
+        self.assertTrue(0 <= positions[0] < positions[-1] < 1)
+
+    def test_export_ring_button(self):
+        filename = bench.synthetic_session(self.path, 1, 200)
+        report = replay.replay(filename, fps=20, clicks=['export_ring'])
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(len(report['exports']), 1)
+        self.assertIn('full', report['exports'][0])
+
+
+class TestCodec(unittest.TestCase):
+    def test_varint(self):
+        out = bytearray()
+        values = [0, 1, 127, 128, 300, 2 ** 40]
+        for value in values:
+            codec.encode_varint(value, out)
+        offset = 0
+        for value in values:
+            result, offset = codec.decode_varint(out, offset)
+            self.assertEqual(result, value)
+
+    def test_zigzag(self):
+        self.assertEqual([codec.zigzag(v) for v in (0, -1, 1, -2, 2)], [0, 1, 2, 3, 4])
+        for value in (0, 1, -1, 12345, -12345, 2 ** 40, -2 ** 40):
+            self.assertEqual(codec.unzigzag(codec.zigzag(value)), value)
+
+    def test_records(self):
+        points = PointArray()
+        points.append(Point(-512.34, 10.5, 1024.01, 250.12, 0.5, 0, 0, 6, 0.000125))
+        points.append(Point(-510.3, 10.4, 1030, 251, 1, 0, 0.25, 6))
+        data = codec.encode_header({'trackname': 'spa'})
+        data += codec.encode_lap(3, 1, 123456, points)
+        data += codec.encode_chunk(4, points, 1)
+        data += codec.encode_drop(4)
+
+        records = list(codec.decode_records(bytes(data)))
+        self.assertEqual([kind for kind, fields, values in records], [
+            codec.RECORD_HEADER, codec.RECORD_LAP, codec.RECORD_CHUNK, codec.RECORD_DROP])
+        self.assertEqual(records[0][1], {'trackname': 'spa'})
+        self.assertEqual(records[1][1], {'count': 3, 'invalid': 1, 'laptime': 123456})
+        lap = PointArray.from_columns(records[1][2])
+        self.assertEqual([p.dumps() for p in lap], [p.dumps() for p in points])
+        self.assertEqual(records[2][2]['z'], [1030])
+        # Truncated data
+        self.assertEqual(len(list(codec.decode_records(bytes(data[:-3])))), 2)
+
 
 class TestMisc(unittest.TestCase):
+    def test_simplify_indexes(self):
+        xs = [0, 1, 2, 3, 4, 5, 5, 5]
+        zs = [0, 0, 0.01, 0, 0, 0, 1, 2]
+        self.assertEqual(simplify_indexes(xs, zs, 0.1), [0, 5, 7])
+        self.assertEqual(simplify_indexes(xs, zs, 0.001), [0, 1, 2, 3, 5, 7])
+
     def test_get_color_from_ratio(self):
         self.assertEqual(get_color_from_ratio(0, mode='gr'), (0, 1, 0, 1))
         self.assertEqual(get_color_from_ratio(0.25, mode='gr'), (0.5, 1, 0, 1))